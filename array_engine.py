@@ -0,0 +1,489 @@
+import numpy as np
+from spacy.attrs import HEAD, POS, DEP, LOWER, LEMMA, ORTH
+
+from extract import SUBJECTS, OBJECTS, BREAKER_POS, NEGATIONS, RELATIVE_WORDS, CONJUNCTIONS, \
+    LOCATION_PREPOSITIONS, SPECIAL_VERB_DEPS, SCAN, EMIT, CHILD, collocation, contains_conj
+
+
+# map an array of attribute ids to their strings, every distinct id is looked up once
+def _to_strings(ids, strings):
+    lookup = {key: strings[key] for key in np.unique(ids).tolist()}
+    return [lookup[key] for key in ids.tolist()]
+
+
+class ArrayDoc:
+    """A parsed Doc exported once into flat arrays.
+
+    Tokens are plain integer indices. Heads come from ``doc.to_array`` and the
+    left/right children of every token are precomputed as slices of one array of
+    child indices sorted by head, so the rules never create Token objects. Token
+    texts are only looked up when the results are turned into strings.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.strings = doc.vocab.strings
+        n = len(doc)
+        array = doc.to_array([HEAD, POS, DEP, LOWER, LEMMA, ORTH]).astype(np.uint64)
+        indices = np.arange(n)
+        # heads are stored as offsets from the token, negative offsets wrap around in uint64
+        heads = indices + array[:, 0].astype(np.int64)
+        self.head = heads.tolist()
+        self.pos = _to_strings(array[:, 1], self.strings)
+        self.dep = _to_strings(array[:, 2], self.strings)
+        self.lower = _to_strings(array[:, 3], self.strings)
+        self.lemma = _to_strings(array[:, 4], self.strings)
+        self._orth = array[:, 5]
+        self._text = None
+
+        # children of every token, grouped by head in index order, lefts first
+        is_child = heads != indices
+        children = np.flatnonzero(is_child)
+        children = children[np.argsort(heads[children], kind="stable")]
+        start = np.concatenate(([0], np.cumsum(np.bincount(heads[is_child], minlength=n))))
+        middle = start[:-1] + np.bincount(heads[is_child & (indices < heads)], minlength=n)
+        self._children = children.tolist()
+        self._start = start.tolist()
+        self._middle = middle.tolist()
+
+    def __len__(self):
+        return len(self.head)
+
+    def lefts(self, i):
+        return self._children[self._start[i]:self._middle[i]]
+
+    def rights(self, i):
+        return self._children[self._middle[i]:self._start[i + 1]]
+
+    def text(self, i):
+        if self._text is None:
+            self._text = _to_strings(self._orth, self.strings)
+        return self._text[i]
+
+    def to_str(self, parts):
+        return ' '.join([self.text(i) for i in parts])
+
+    def is_non_aux_verb(self, i):
+        return self.pos[i] == "VERB" and (self.dep[i] not in SPECIAL_VERB_DEPS and self.dep[i] != "advcl") or \
+            self.pos[i] == "AUX" and (self.dep[i] != "aux" and self.dep[i] != "auxpass")
+
+    def is_verb(self, i):
+        return self.pos[i] == "VERB" or self.pos[i] == "AUX"
+
+    def find_verbs(self):
+        verbs = [i for i in range(len(self)) if self.is_non_aux_verb(i)]
+        if len(verbs) == 0:
+            verbs = [i for i in range(len(self)) if self.is_verb(i)]
+        return verbs
+
+    def subs_from_conjunctions(self, subs):
+        more_subs = []
+        for sub in subs:
+            rights = self.rights(sub)
+            if contains_conj({self.lower[tok] for tok in rights}):
+                more_subs.extend([tok for tok in rights if self.dep[tok] in SUBJECTS or self.pos[tok] == "NOUN"])
+                if len(more_subs) > 0:
+                    more_subs.extend(self.subs_from_conjunctions(more_subs))
+        return more_subs
+
+    def objs_from_conjunctions(self, objs):
+        more_objs = []
+        for obj in objs:
+            rights = self.rights(obj)
+            if contains_conj({self.lower[tok] for tok in rights}):
+                more_objs.extend([tok for tok in rights if self.dep[tok] in OBJECTS or self.pos[tok] == "NOUN"])
+                if len(more_objs) > 0:
+                    more_objs.extend(self.objs_from_conjunctions(more_objs))
+        return more_objs
+
+    def center_verb(self, v_list):
+        for v in v_list:
+            if self.head[v] not in v_list:
+                return v
+
+    def find_subs(self, toks):
+        if isinstance(toks, list):
+            tok = self.center_verb(toks)
+            if tok is None:
+                # no subjects, see extract._find_subs
+                return [], False
+            head = self.head[tok]
+        else:
+            head = self.head[toks]
+        while self.pos[head] != "VERB" and self.pos[head] != "NOUN" and self.head[head] != head:
+            head = self.head[head]
+        if self.pos[head] == "VERB" or self.pos[head] == "AUX":
+            subs = [tok for tok in self.lefts(head) if self.dep[tok] in SUBJECTS]
+            if len(subs) > 0:
+                subs.extend(self.subs_from_conjunctions(subs))
+                return subs, False
+            elif self.head[head] != head:
+                return self.find_subs(head)
+        elif self.pos[head] == "NOUN":
+            return [head], False
+        return [], False
+
+    def get_all_subs(self, v_list):
+        verb_negated = False
+        subs = [tok for v in v_list for tok in self.lefts(v) if self.dep[tok] in SUBJECTS and self.pos[tok] != "DET"]
+        if len(subs) > 0:
+            subs.extend(self.subs_from_conjunctions(subs))
+        else:
+            found_subs, verb_negated = self.find_subs(v_list)
+            subs.extend(found_subs)
+        return subs, verb_negated
+
+    def right_of_verb_is_conj_verb(self, v_list):
+        rights = []
+        for v in v_list:
+            rights.extend(self.rights(v))
+
+        if len(rights) > 1 and self.pos[rights[0]] == 'CCONJ':
+            for tok in rights[1:]:
+                if self.is_non_aux_verb(tok):
+                    return True, self.expand_verb(tok)
+
+        return False, v_list
+
+    def get_all_objs(self, v_list, visited):
+        rights = []
+        for v in v_list:
+            rights.extend(self.rights(v))
+
+        objs = [tok for tok in rights if tok not in visited and (self.dep[tok] in OBJECTS)]
+        if len(objs) > 0:
+            objs.extend(self.objs_from_conjunctions(objs))
+        return v_list, objs
+
+    def that_resolution(self):
+        for tok in range(len(self)):
+            if 'that' in [self.text(t) for t in self.lefts(tok)]:
+                return self.head[tok]
+        return None
+
+    def expand_verb(self, verb):
+        verb_lefts = self.lefts(verb)
+        verb_rights = self.rights(verb)
+
+        if len(verb_lefts) == 0:
+            lefts = ['']
+        elif self.pos[verb_lefts[-1]] not in {"NOUN", "PROPN", "PRON", "DET"}:
+            lefts = ['', self.lower[verb_lefts[-1]]]
+        else:
+            lefts = ['']
+
+        if len(verb_rights) == 0 or self.pos[verb] == "AUX":
+            rights = ['']
+        elif len(verb_rights) == 1:
+            rights = ['', self.lower[verb_rights[0]]]
+        else:
+            rights = ['', self.lower[verb_rights[0]], self.lower[verb_rights[0]] + ' ' + self.lower[verb_rights[1]]]
+
+        matched = collocation.match(self.lower[verb], lefts[::-1], rights[::-1])
+        if matched is not None:
+            left, right = matched
+            expanded = []
+            if left != '':
+                expanded.append(verb_lefts[-1])
+            expanded.append(verb)
+            if right != '':
+                if ' ' in right:
+                    expanded.append(verb_rights[0])
+                    expanded.append(verb_rights[1])
+                else:
+                    expanded.append(verb_rights[0])
+            return expanded
+
+        if len(verb_lefts) > 1 and self.dep[verb_lefts[-1]] == "neg":
+            return [verb_lefts[-1], verb]
+
+        return [verb]
+
+    def _breaks(self, part):
+        return self.pos[part] in BREAKER_POS and self.dep[part] not in SPECIAL_VERB_DEPS
+
+    def is_leaf(self, i):
+        return self._start[i] == self._start[i + 1]
+
+    def expand(self, item, visited, isfirst=False):
+        if isfirst and item in visited:
+            return []
+        return self.expand_span(item, visited)
+
+    # the iterative span expansion of extract._expand_span on token indices
+    def expand_span(self, item, visited, lefts=True, emit_item=True, rights=True, check_visited=True,
+                    mark_only=False):
+        parts = []
+        stack = []
+        if rights:
+            stack.append((SCAN, iter(self.rights(item)), check_visited, mark_only))
+        if emit_item:
+            stack.append((EMIT, item))
+        if lefts:
+            stack.append((SCAN, iter(self.lefts(item)), check_visited, mark_only))
+
+        while stack:
+            action = stack.pop()
+            if action[0] == EMIT:
+                parts.append(action[1])
+            elif action[0] == SCAN:
+                _, children, check, mark = action
+                part = next(children, None)
+                if part is None or self._breaks(part) or check and part in visited:
+                    continue
+                stack.append(action)
+                if self.lower[part] in NEGATIONS:
+                    continue
+                if self.is_leaf(part):
+                    parts.append(part)
+                    continue
+                stack.append((CHILD, iter(self.rights(part)), mark))
+                stack.append((EMIT, part))
+                stack.append((CHILD, iter(self.lefts(part)), mark))
+            else:
+                _, children, mark = action
+                child = next(children, None)
+                if child is None:
+                    continue
+                stack.append(action)
+                if child in visited:
+                    continue
+                visited.add(child)
+                if mark:
+                    continue
+                if self.is_leaf(child):
+                    parts.append(child)
+                    continue
+                stack.append((SCAN, iter(self.rights(child)), True, False))
+                stack.append((EMIT, child))
+                stack.append((SCAN, iter(self.lefts(child)), True, False))
+
+        return parts
+
+    def get_subject(self, item, visited):
+        return self.expand_span(item, visited, rights=False, check_visited=False, mark_only=True)
+
+    def get_modifier(self, item, visited):
+        return self.expand_span(item, visited, lefts=False, emit_item=False, check_visited=False)
+
+    def split_mods(self, tokens):
+        split_mods = []
+        split_mod = []
+        for token in tokens:
+            head = self.head[token]
+            if (self.pos[token] == "ADP" and self.dep[token] == "prep" and self.lower[token] in LOCATION_PREPOSITIONS) or \
+                    (self.pos[token] == "SCONJ" and self.lower[token] in CONJUNCTIONS) or \
+                    (self.pos[head] == "VERB" and self.dep[head] == "advcl" and self.lower[token] == 'to'):
+                if len(split_mod) > 0:
+                    split_mods.append(split_mod)
+                split_mod = [token]
+            else:
+                split_mod.append(token)
+        if len(split_mod) > 0:
+            split_mods.append(split_mod)
+        return split_mods
+
+    def mods_from_prepositions(self, deps, visited):
+        mods = []
+        for dep in deps:
+            if self.pos[dep] == "ADP" and self.dep[dep] == "prep":
+                mods.extend(self.expand(dep, visited, True))
+        return self.split_mods(mods)
+
+    def mods_from_clauses(self, deps, visited):
+        mods = []
+        for dep in deps:
+            for item in self.lefts(dep):
+                if self.pos[item] == "SCONJ" and (self.lower[item] == 'that' or self.lower[item] == 'if'):
+                    mods.extend(self.expand(dep, visited, True))
+        return self.split_mods(mods)
+
+    def mods_from_inf(self, deps, visited):
+        mods = []
+        for dep in deps:
+            if self.pos[dep] == "VERB" and self.dep[dep] == "advcl":
+                mods.extend(self.expand(dep, visited, True))
+        return self.split_mods(mods)
+
+    def children_of_verb(self, v_list):
+        children = []
+        for v in v_list:
+            children.extend(self.lefts(v) + self.rights(v))
+        return children
+
+
+class ArrayAnalysis:
+    """Drop-in replacement for extract.DocumentAnalysis that runs the rules on an ArrayDoc.
+
+    It returns the same SVO, SM and VM relations as the Token based rules. Subjects
+    and objects are (ArrayDoc, index) pairs because a coreference antecedent can be
+    a token of another sentence.
+    """
+
+    def __init__(self, tokens, coref=None):
+        self.array = ArrayDoc(tokens)
+        self.coref = coref
+        self._arrays = {id(tokens): self.array}
+        self.verbs = []
+        for v in self.array.find_verbs():
+            expanded_verb = self.array.expand_verb(v)
+            subs, verb_negated = self.array.get_all_subs(expanded_verb)
+            self.verbs.append((expanded_verb, subs, verb_negated, self.array.children_of_verb(expanded_verb)))
+
+    def _array_of(self, doc):
+        array = self._arrays.get(id(doc))
+        if array is None:
+            array = self._arrays[id(doc)] = ArrayDoc(doc)
+        return array
+
+    def _process_relative_word_and_pron(self, items, visited):
+        objs = []
+        for array, item in items:
+            head = array.head[item]
+            if array.lemma[item] in RELATIVE_WORDS and (
+                    array.dep[item] == "nsubjpass" or array.dep[item] == "nsubj") and array.dep[head] == "relcl":
+                visited.add(item)
+                visited.add(head)
+                objs.append((array, array.head[head]))
+            elif self.coref is not None and array.pos[item] == "PRON":
+                result = self.coref.resolve_token(array.doc[item])
+                if result is not None:
+                    objs.append((self._array_of(result.doc), result.i))
+                else:
+                    objs.append((array, item))
+            else:
+                objs.append((array, item))
+        return objs, visited
+
+    # the visited set for the indices of `array`, every other sentence that an antecedent comes from gets its own
+    # set in `foreign` (see extract.DocumentAnalysis._visited)
+    def _visited(self, array, visited, foreign):
+        if array is self.array:
+            return visited
+        return foreign.setdefault(id(array), set())
+
+    def _subject(self, sub, visited, foreign):
+        array, item = sub
+        return array.to_str(array.get_subject(item, self._visited(array, visited, foreign)))
+
+    def _modifier(self, sub, visited, foreign):
+        array, item = sub
+        if array.lower[item] == 'that':
+            resolved = self.array.that_resolution()
+            if resolved is not None:
+                array, item = self.array, resolved
+        return array.to_str(array.get_modifier(item, self._visited(array, visited, foreign)))
+
+    def _objects(self, objs, visited, foreign):
+        parts = []
+        for array, item in objs:
+            parts.extend(array.text(i) for i in array.expand(item, self._visited(array, visited, foreign), True))
+        return ' '.join(parts)
+
+    def relations(self):
+        return self.svos(), self.sms(), self.vms()
+
+    def svos(self):
+        to_str = self.array.to_str
+        svos = []
+        for expanded_verb, subs, verbNegated, _ in self.verbs:
+            visited = set(expanded_verb)
+            foreign = {}
+            if len(subs) > 0:
+                isConjVerb, conjV = self.array.right_of_verb_is_conj_verb(expanded_verb)
+                if isConjVerb:
+                    v2, objs = self.array.get_all_objs(conjV, visited)
+                    objs = [(self.array, obj) for obj in objs]
+                    for sub in subs:
+                        sub, visited = self._process_relative_word_and_pron([(self.array, sub)], visited)
+                        sub = sub[0]
+                        if len(objs) > 0:
+                            objs, visited = self._process_relative_word_and_pron(objs, visited)
+
+                            svos.append((self._subject(sub, visited, foreign),
+                                         "!" + to_str(expanded_verb) if verbNegated else to_str(expanded_verb),
+                                         self._objects(objs, visited, foreign)))
+                            svos.append((self._subject(sub, visited, foreign),
+                                         "!" + to_str(v2) if verbNegated else to_str(v2),
+                                         self._objects(objs, visited, foreign)))
+                        else:
+                            svos.append((self._subject(sub, visited, foreign),
+                                         "!" + to_str(expanded_verb) if verbNegated else to_str(expanded_verb),))
+                else:
+                    v, objs = self.array.get_all_objs(expanded_verb, visited)
+                    objs = [(self.array, obj) for obj in objs]
+                    for sub in subs:
+                        sub, visited = self._process_relative_word_and_pron([(self.array, sub)], visited)
+                        sub = sub[0]
+                        if len(objs) > 0:
+                            objs, visited = self._process_relative_word_and_pron(objs, visited)
+
+                            svos.append((self._subject(sub, visited, foreign),
+                                         "!" + to_str(v) if verbNegated else to_str(v),
+                                         self._objects(objs, visited, foreign)))
+                        else:
+                            svos.append((self._subject(sub, visited, foreign),
+                                         "!" + to_str(v) if verbNegated else to_str(v),))
+
+        return svos
+
+    def sms(self):
+        sms = set()
+        for expanded_verb, subs, _, _ in self.verbs:
+            visited = set(expanded_verb)
+            foreign = {}
+            if len(subs) > 0:
+                for sub in subs:
+                    sub, visited = self._process_relative_word_and_pron([(self.array, sub)], visited)
+                    sub = sub[0]
+                    sms.add((self._subject(sub, visited, foreign), self._modifier(sub, visited, foreign)))
+
+        return list(sms)
+
+    def vms(self):
+        to_str = self.array.to_str
+        vms = []
+        for expanded_verb, _, _, children in self.verbs:
+            visited = set(expanded_verb)
+            p_mods = self.array.mods_from_prepositions(children, visited)
+            c_mods = self.array.mods_from_clauses(children, visited)
+            i_mods = self.array.mods_from_inf(children, visited)
+            if len(p_mods) > 0:
+                vms.append((to_str(expanded_verb), [to_str(p_mod) for p_mod in p_mods]))
+            elif len(c_mods) > 0:
+                vms.append((to_str(expanded_verb), [to_str(c_mod) for c_mod in c_mods]))
+            elif len(i_mods) > 0:
+                vms.append((to_str(expanded_verb), [to_str(i_mod) for i_mod in i_mods]))
+            else:
+                vms.append((to_str(expanded_verb), ''))
+
+        return vms
+
+
+# check that both engines extract the same relations from a corpus with one sentence per line
+def main():
+    import argparse
+    from extract import DocumentAnalysis, nlp
+
+    parser = argparse.ArgumentParser(description="Compare the array engine with the Token based rules.")
+    parser.add_argument("--corpus", default="test/sample.txt", help="one sentence per line")
+    args = parser.parse_args()
+
+    with open(args.corpus, "r", encoding='utf-8') as f:
+        texts = f.read().splitlines()
+
+    mismatches = 0
+    for index, tokens in enumerate(nlp.pipe(texts)):
+        expected = DocumentAnalysis(tokens).relations()
+        found = ArrayAnalysis(tokens).relations()
+        # SMs are collected in a set, their order is not stable
+        if (expected[0], sorted(expected[1]), expected[2]) != (found[0], sorted(found[1]), found[2]):
+            mismatches += 1
+            print(f"========={index}=========\n{texts[index]}\nspacy: {expected}\narray: {found}")
+    print(f"{len(texts) - mismatches} of {len(texts)} sentences identical")
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
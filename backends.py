@@ -0,0 +1,87 @@
+import os
+import torch
+from torch import nn
+
+# "torch": fp32 eager PyTorch, "quantized": int8 dynamic quantization of every nn.Linear (CPU only),
+# "onnx": ONNX Runtime on CPU, the model is exported next to its weights on first use
+BACKENDS = ("torch", "quantized", "onnx")
+
+
+class LogitsModel(nn.Module):
+    """Wraps a model so that it is called as ``model(input_ids, attention_mask)`` and returns the logits."""
+
+    def __init__(self, module, logits_fn):
+        super().__init__()
+        self.module = module
+        self.logits_fn = logits_fn
+
+    @property
+    def device(self):
+        return next(self.parameters()).device
+
+    def forward(self, input_ids, attention_mask):
+        return self.logits_fn(self.module, input_ids, attention_mask)
+
+
+class OnnxLogitsModel:
+    """Runs an exported LogitsModel with ONNX Runtime, taking and returning torch tensors."""
+
+    device = torch.device("cpu")
+
+    def __init__(self, path, threads=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    @staticmethod
+    def export(model, path):
+        input_ids = torch.ones((1, 8), dtype=torch.long)
+        attention_mask = torch.ones((1, 8), dtype=torch.long)
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in ("input_ids", "attention_mask", "logits")}
+        with torch.no_grad():
+            torch.onnx.export(model, (input_ids, attention_mask), path,
+                              input_names=["input_ids", "attention_mask"], output_names=["logits"],
+                              dynamic_axes=dynamic_axes, opset_version=13)
+
+    def __call__(self, input_ids, attention_mask):
+        logits, = self.session.run(["logits"], {"input_ids": input_ids.cpu().numpy(),
+                                                "attention_mask": attention_mask.cpu().numpy()})
+        return torch.from_numpy(logits)
+
+
+# turn an eval-mode model into a callable for the given backend, see BACKENDS. source_path is the file the weights
+# were loaded from, an ONNX export older than it is exported again.
+def prepare(module, logits_fn, backend="torch", onnx_path=None, source_path=None):
+    model = LogitsModel(module, logits_fn).eval()
+    if backend == "torch":
+        return model
+    if backend == "quantized":
+        return torch.quantization.quantize_dynamic(model.cpu(), {nn.Linear}, dtype=torch.qint8)
+    if backend == "onnx":
+        if onnx_path is None:
+            raise ValueError("the onnx backend needs an onnx_path to export the model to")
+        if not os.path.exists(onnx_path) or source_path is not None and os.path.exists(source_path) and \
+                os.path.getmtime(onnx_path) < os.path.getmtime(source_path):
+            OnnxLogitsModel.export(model.cpu(), onnx_path)
+        return OnnxLogitsModel(onnx_path)
+    raise ValueError(f"unknown backend {backend!r}, expected one of {BACKENDS}")
+
+
+# split the positions of sequences into batches of at most batch_size sequences of similar length, so that every
+# batch is only padded to its own longest sequence
+def length_buckets(lengths, batch_size):
+    order = sorted(range(len(lengths)), key=lambda index: lengths[index])
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+# right-pad lists of token ids to the longest one, returns the input_ids and attention_mask tensors
+def pad_batch(sequences, pad_id):
+    length = max(len(sequence) for sequence in sequences)
+    input_ids = torch.full((len(sequences), length), pad_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), length), dtype=torch.long)
+    for row, sequence in enumerate(sequences):
+        input_ids[row, :len(sequence)] = torch.tensor(sequence, dtype=torch.long)
+        attention_mask[row, :len(sequence)] = 1
+    return input_ids, attention_mask
@@ -0,0 +1,353 @@
+import argparse
+import ast
+import multiprocessing
+import os
+import re
+import sys
+import time
+from itertools import cycle
+
+from spacy.tokens import Doc
+
+import causal_extractor
+import inference
+import pipeline
+import runner
+from backends import BACKENDS
+from component import ENGINES
+from coref import coref_chains
+from extract import nlp
+from metrics import percentile
+from causal_classifier import get_labels
+from causal_extractor import batch_tag
+
+STAGES = ("parse", "coref", "rules", "get_label", "tagger")
+FIELDS = {"SVO": "svos", "SM": "sms", "VM": "vms", "CE": "ce"}
+# worker pools of the memory command: every worker loads its own models, or shares the models preloaded by the parent
+MEMORY_MODES = ("separate", "preload")
+
+
+def _read_corpus(path):
+    with open(path, "r", encoding='utf-8') as f:
+        return [line for line in f.read().splitlines() if line.strip()]
+
+
+# time fn on every chunk of `batch_size` items, one latency per call
+def _timed(fn, items, batch_size):
+    latencies = []
+    outputs = []
+    for start in range(0, len(items), batch_size):
+        chunk = items[start:start + batch_size]
+        begin = time.perf_counter()
+        outputs.extend(fn(chunk))
+        latencies.append(time.perf_counter() - begin)
+    return outputs, latencies
+
+
+# time every stage separately on the same sentences
+def time_stages(texts, batch_size, stages=STAGES):
+    timings = {}
+    docs, timings["parse"] = _timed(lambda chunk: nlp.pipe(chunk, batch_size=batch_size), texts, batch_size)
+    corefs = [None] * len(texts)
+    if "coref" in stages:
+        # coref_chains resolves one sentence at a time
+        corefs, timings["coref"] = _timed(lambda chunk: [coref_chains(text) for text in chunk], texts, 1)
+    if "rules" in stages:
+        pairs = list(zip(docs, corefs))
+        _, timings["rules"] = _timed(lambda chunk: [pipeline.ANALYSIS(doc, chain).relations()
+                                                    for doc, chain in chunk], pairs, 1)
+    if "get_label" in stages:
+        _, timings["get_label"] = _timed(lambda chunk: get_labels(chunk, batch_size), texts, batch_size)
+    if "tagger" in stages:
+        # the tagger runs on every sentence, as if the classifier had found all of them causal
+        _, timings["tagger"] = _timed(lambda chunk: batch_tag(chunk, batch_size), texts, batch_size)
+    return {stage: timings[stage] for stage in STAGES if stage in timings}
+
+
+def _summary(latencies, sentences):
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {
+        "sentences": sentences,
+        "seconds": total,
+        "sentences_per_second": sentences / total if total else 0.0,
+        "p50_ms": percentile(ordered, 50) * 1000,
+        "p95_ms": percentile(ordered, 95) * 1000,
+        "p99_ms": percentile(ordered, 99) * 1000,
+    }
+
+
+# split texts into buckets by their number of whitespace separated words, edges are the bucket boundaries
+def length_buckets(texts, edges):
+    bounds = [0] + sorted(edges) + [None]
+    buckets = []
+    for low, high in zip(bounds, bounds[1:]):
+        name = f"{low}-{high - 1}" if high is not None else f"{low}+"
+        members = [text for text in texts if len(text.split()) >= low and (high is None or len(text.split()) < high)]
+        if members:
+            buckets.append((name, members))
+    return buckets
+
+
+def benchmark_stages(texts, batch_sizes, edges, stages=STAGES):
+    rows = []
+    for bucket, members in [("all", texts)] + (length_buckets(texts, edges) if edges else []):
+        for batch_size in batch_sizes:
+            for stage, latencies in time_stages(members, batch_size, stages).items():
+                rows.append({"stage": stage, "batch_size": batch_size, "length": bucket,
+                             **_summary(latencies, len(members))})
+    return rows
+
+
+def _print_stage_report(rows):
+    print(f"{'stage':>10} {'batch':>6} {'length':>8} {'sentences':>9} {'sent/s':>9} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for row in rows:
+        print(f"{row['stage']:>10} {row['batch_size']:>6} {row['length']:>8} {row['sentences']:>9} "
+              f"{row['sentences_per_second']:>9.1f} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f}")
+
+
+# "users love big big ... big mice": every adjective modifies the next one, so expanding the object descends
+# through `length` nested children
+def chain_doc(vocab, length):
+    words = ["users", "love"] + ["big"] * length + ["mice"]
+    heads = [1, 1] + list(range(3, length + 3)) + [1]
+    deps = ["nsubj", "ROOT"] + ["amod"] * length + ["dobj"]
+    pos = ["NOUN", "VERB"] + ["ADJ"] * length + ["NOUN"]
+    return Doc(vocab, words=words, heads=heads, deps=deps, pos=pos)
+
+
+# corpus sentences joined with ", and" until every sentence has at least `length` tokens
+def long_sentences(texts, length, count):
+    sentences = []
+    pool = cycle(texts)
+    for _ in range(count):
+        parts = []
+        while sum(len(part.split()) for part in parts) < length:
+            parts.append(next(pool).rstrip('.'))
+        sentences.append(", and ".join(parts) + ".")
+    return sentences
+
+
+# run the rules on long parsed sentences and on deep chains, returns a row per kind and length
+def stress(texts, lengths, count=20):
+    rows = []
+    for length in lengths:
+        parsed = list(nlp.pipe(long_sentences(texts, length, count)))
+        for kind, docs in (("parsed", parsed), ("chain", [chain_doc(nlp.vocab, length)] * count)):
+            latencies = []
+            failures = {}
+            for doc in docs:
+                start = time.perf_counter()
+                try:
+                    pipeline.ANALYSIS(doc).relations()
+                except Exception as error:
+                    failures[type(error).__name__] = failures.get(type(error).__name__, 0) + 1
+                latencies.append(time.perf_counter() - start)
+            rows.append({"kind": kind, "length": length, "tokens": max(len(doc) for doc in docs),
+                         "failures": failures, **_summary(latencies, len(docs))})
+    return rows
+
+
+# the peak MB column is the CUDA peak of a call, CPU sessions have none and share the peak RSS of the process
+def _print_session_report(rows):
+    print(f"{'model':>10} {'device':>7} {'calls':>6} {'mean ms':>9} {'max ms':>9} {'peak MB':>9}")
+    for row in rows:
+        peak = "-" if row['peak_bytes'] is None else f"{row['peak_bytes'] / 1024 / 1024:.0f}"
+        print(f"{row['model']:>10} {row['device']:>7} {row['calls']:>6} {row['mean_ms']:>9.2f} {row['max_ms']:>9.2f} "
+              f"{peak:>9}")
+    print(f"process peak RSS {inference.process_peak_rss() / 1024 / 1024:.0f} MB")
+
+
+def _print_stress_report(rows):
+    print(f"{'kind':>7} {'length':>7} {'tokens':>7} {'p50 ms':>9} {'p99 ms':>9}  failures")
+    for row in rows:
+        print(f"{row['kind']:>7} {row['length']:>7} {row['tokens']:>7} {row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f}  "
+              f"{row['failures'] or '-'}")
+
+
+# sentences per second of extract_stream run stage after stage and with the parser overlapping the CE models,
+# for every number of torch intra-op threads
+def overlap(texts, batch_size, thread_counts, use_coref=True):
+    rows = []
+    for threads in thread_counts:
+        for overlapped in (False, True):
+            start = time.perf_counter()
+            for _ in pipeline.extract_stream(texts, batch_size, use_coref, overlap=overlapped, torch_threads=threads):
+                pass
+            seconds = time.perf_counter() - start
+            rows.append({"torch_threads": threads, "overlap": overlapped, "seconds": seconds,
+                         "sentences_per_second": len(texts) / seconds if seconds else 0.0})
+    return rows
+
+
+def _print_overlap_report(rows):
+    print(f"{'threads':>7} {'overlap':>7} {'seconds':>9} {'sent/s':>9}")
+    for row in rows:
+        print(f"{row['torch_threads']:>7} {str(row['overlap']):>7} {row['seconds']:>9.2f} "
+              f"{row['sentences_per_second']:>9.1f}")
+
+
+# resident (Rss) and proportional (Pss) set size of a process in MB. Pss splits every shared page between the
+# processes that map it, so the Pss of a pool adds up to the memory it really uses.
+def memory_usage(pid="self"):
+    usage = {}
+    with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ("Rss", "Pss", "Shared_Clean", "Private_Dirty"):
+                usage[name.lower()] = int(value.split()[0]) / 1024
+    return usage
+
+
+def _extract_in_worker(texts):
+    runner._process(texts)
+    return os.getpid()
+
+
+# memory of runner.py pools with a growing number of workers, measured after the workers have extracted `texts`.
+# The preload mode runs last, the parent keeps the preloaded models.
+def memory(texts, worker_counts, modes=MEMORY_MODES, backend="torch", use_coref=True, use_ce=True):
+    options = {"use_coref": use_coref, "use_ce": use_ce, "coref_window": None}
+    rows = []
+    for mode in sorted(modes, key=MEMORY_MODES.index):
+        for workers in worker_counts:
+            with runner._pool(workers, options, 1, backend, preload_models=mode == "preload") as pool:
+                pool.map(_extract_in_worker, [texts] * workers * 2, chunksize=1)
+                parent = memory_usage(os.getpid())
+                children = [memory_usage(child.pid) for child in multiprocessing.active_children()]
+            rows.append({"mode": mode, "workers": workers, "parent_rss": parent["rss"],
+                         "worker_rss": sum(child["rss"] for child in children),
+                         "worker_private": sum(child["private_dirty"] for child in children),
+                         "total_pss": parent["pss"] + sum(child["pss"] for child in children)})
+    return rows
+
+
+def _print_memory_report(rows):
+    print(f"{'mode':>9} {'workers':>7} {'parent Rss':>11} {'worker Rss':>11} {'private':>9} {'total Pss':>10} "
+          f"{'Pss/worker':>10}  (MB)")
+    for row in rows:
+        print(f"{row['mode']:>9} {row['workers']:>7} {row['parent_rss']:>11.0f} {row['worker_rss']:>11.0f} "
+              f"{row['worker_private']:>9.0f} {row['total_pss']:>10.0f} {row['total_pss'] / row['workers']:>10.0f}")
+
+
+# parse the output of demo.py, every block becomes a dict with text, svos, sms, vms and ce
+def read_golden(path):
+    with open(path, "r", encoding='utf-8') as f:
+        content = f.read()
+    expected = []
+    for block in re.split(r"^=========\d+=========$", content, flags=re.MULTILINE):
+        if not block.strip():
+            continue
+        record = {}
+        for line in block.strip().splitlines():
+            name, _, value = line.partition(':')
+            if name == "text":
+                record["text"] = value.strip()
+            elif name in FIELDS:
+                record[FIELDS[name]] = ast.literal_eval(value.strip())
+        expected.append(record)
+    return expected
+
+
+# the SMs of a sentence come from a set, so their order is not part of the result
+def _comparable(field, value):
+    if field == "sms":
+        return sorted(value, key=repr)
+    return value
+
+
+# extract the golden texts again, returns (sentence index, field, expected, result) for every difference
+def golden_check(expected, batch_size=32):
+    texts = [record["text"] for record in expected]
+    mismatches = []
+    for index, (record, result) in enumerate(zip(expected, pipeline.extract_stream(texts, batch_size))):
+        for field in FIELDS.values():
+            if _comparable(field, getattr(result, field)) != _comparable(field, record[field]):
+                mismatches.append((index, field, record[field], getattr(result, field)))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the speed of the extraction stages and check that the "
+                                                 "output has not changed.")
+    parser.add_argument("--engine", default="token", choices=sorted(ENGINES), help="rule engine, see pipeline.ANALYSIS")
+    parser.add_argument("--backend", default="torch", choices=BACKENDS, help="inference backend of the CE models")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stages_parser = subparsers.add_parser("stages", help="throughput and latency of every stage")
+    stages_parser.add_argument("--corpus", default="test/sample.txt", help="one sentence per line")
+    stages_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    stages_parser.add_argument("--length-edges", type=int, nargs="*", default=[16, 32],
+                               help="word counts that separate the sentence length buckets")
+    stages_parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES,
+                               help="stages to time, parsing always runs")
+    stages_parser.add_argument("--repeat", type=int, default=1, help="run over the corpus this many times")
+
+    stress_parser = subparsers.add_parser("stress", help="run the rules on sentences of hundreds of tokens, fails "
+                                                         "when the recursion limit is hit")
+    stress_parser.add_argument("--corpus", default="test/sample.txt", help="sentences joined into long sentences")
+    stress_parser.add_argument("--lengths", type=int, nargs="+", default=[200, 500, 2000],
+                               help="minimum number of tokens per sentence")
+    stress_parser.add_argument("--count", type=int, default=20, help="sentences per length")
+
+    overlap_parser = subparsers.add_parser("overlap", help="throughput with and without the parser overlapping "
+                                                           "the CE models")
+    overlap_parser.add_argument("--corpus", default="test/sample.txt", help="one sentence per line")
+    overlap_parser.add_argument("--batch-size", type=int, default=32)
+    overlap_parser.add_argument("--torch-threads", type=int, nargs="+",
+                                default=[1, max(1, (os.cpu_count() or 2) - 1)],
+                                help="torch intra-op thread counts to measure")
+    overlap_parser.add_argument("--repeat", type=int, default=1, help="run over the corpus this many times")
+    overlap_parser.add_argument("--no-coref", dest="use_coref", action="store_false",
+                                help="skip coreference resolution")
+
+    memory_parser = subparsers.add_parser("memory", help="memory of runner.py worker pools with and without "
+                                                         "preloaded models")
+    memory_parser.add_argument("--corpus", default="test/sample.txt", help="sentences every worker extracts first")
+    memory_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="pool sizes to measure")
+    memory_parser.add_argument("--modes", nargs="+", default=list(MEMORY_MODES), choices=MEMORY_MODES)
+    memory_parser.add_argument("--no-coref", dest="use_coref", action="store_false", help="skip coreference resolution")
+    memory_parser.add_argument("--no-ce", dest="use_ce", action="store_false", help="skip cause-and-effect extraction")
+
+    golden_parser = subparsers.add_parser("golden", help="fail when the relations differ from the expected output")
+    golden_parser.add_argument("--expected", default="test/result.txt", help="output of demo.py")
+    golden_parser.add_argument("--batch-size", type=int, default=32)
+
+    args = parser.parse_args()
+    if args.command == "memory" and "preload" in args.modes and args.backend == "onnx":
+        parser.error("the preload mode needs the torch or quantized backend, ONNX Runtime sessions do not survive "
+                     "a fork")
+    pipeline.ANALYSIS = ENGINES[args.engine]
+    causal_extractor.set_backend(args.backend)
+    if args.command == "stages":
+        pipeline.pipeline.load(use_coref="coref" in args.stages,
+                               use_ce="get_label" in args.stages or "tagger" in args.stages)
+        texts = _read_corpus(args.corpus) * args.repeat
+        _print_stage_report(benchmark_stages(texts, args.batch_sizes, args.length_edges, args.stages))
+        _print_session_report(inference.report())
+    elif args.command == "stress":
+        rows = stress(_read_corpus(args.corpus), args.lengths, args.count)
+        _print_stress_report(rows)
+        if any("RecursionError" in row["failures"] for row in rows):
+            sys.exit(1)
+    elif args.command == "overlap":
+        pipeline.pipeline.load(use_coref=args.use_coref)
+        texts = _read_corpus(args.corpus) * args.repeat
+        _print_overlap_report(overlap(texts, args.batch_size, args.torch_threads, args.use_coref))
+    elif args.command == "memory":
+        texts = _read_corpus(args.corpus)[:16]
+        _print_memory_report(memory(texts, args.workers, args.modes, args.backend, args.use_coref, args.use_ce))
+    elif args.command == "golden":
+        expected = read_golden(args.expected)
+        mismatches = golden_check(expected, args.batch_size)
+        for index, field, wanted, got in mismatches:
+            print(f"sentence {index} {field}: expected {wanted!r}, got {got!r}")
+        failed = len({index for index, _, _, _ in mismatches})
+        print(f"{len(expected) - failed} of {len(expected)} sentences match")
+        if mismatches:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from metrics import registry
+
+
+# sentences that only differ in surrounding or repeated whitespace share a cache entry
+def normalize(text):
+    return ' '.join(text.split())
+
+
+# hash of everything the results depend on, existing files are identified by their path, size and mtime
+def fingerprint(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        part = str(part)
+        if os.path.isfile(part):
+            stat = os.stat(part)
+            part = f"{part}:{stat.st_size}:{stat.st_mtime_ns}"
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Extraction results keyed by normalised sentence text and a fingerprint.
+
+    The memory tier is an LRU that evicts the least recently used entries once
+    the pickled results exceed ``max_bytes``. With ``path`` set, results are also
+    kept in an SQLite file that several worker processes can share; entries
+    found there are promoted to the memory tier.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, path=None, fingerprint=""):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.fingerprint = fingerprint
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def key(self, text):
+        return hashlib.sha256((self.fingerprint + '\0' + normalize(text)).encode('utf-8')).hexdigest()
+
+    def get(self, text):
+        key = self.key(text)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                registry.count("cache_lookups", result="hit")
+                return pickle.loads(data)
+        data = self._disk_get(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                registry.count("cache_lookups", result="miss")
+                return None
+            self.disk_hits += 1
+            self._remember(key, data)
+        registry.count("cache_lookups", result="disk_hit")
+        return pickle.loads(data)
+
+    def put(self, text, value):
+        key = self.key(text)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._remember(key, data)
+        self._disk_put(key, data)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "evictions": self.evictions,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remember(self, key, data):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        if len(data) > self.max_bytes:
+            return
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    # one connection per process, a connection inherited through fork is not reused
+    def _db(self):
+        if self.path is None:
+            return None
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB)")
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def _disk_get(self, key):
+        with self._lock:
+            db = self._db()
+            if db is None:
+                return None
+            row = db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def _disk_put(self, key, data):
+        with self._lock:
+            db = self._db()
+            if db is None:
+                return
+            db.execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)", (key, data))
+            db.commit()
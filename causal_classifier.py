@@ -1,6 +1,10 @@
-from transformers import BertModel, BertTokenizer
+import os
+from transformers import BertModel, BertTokenizerFast
 import torch
 from torch import nn
+import backends
+import inference
+from resources import LazyResource
 
 PRE_TRAINED_MODEL_NAME = "bert-base-uncased"
 
@@ -23,21 +27,55 @@ class CausalClassifier(nn.Module):
         return self.out(output)
 
 
-tokenizer = BertTokenizer.from_pretrained(PRE_TRAINED_MODEL_NAME)
-model = CausalClassifier(2)
+def _classifier_logits(classifier, input_ids, attention_mask):
+    return classifier({"input_ids": input_ids, "attention_mask": attention_mask})
 
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-model = model.to(device)
-model.load_state_dict(torch.load("./models/causal_classifier.bin"))
-model.eval()
+
+# backend is one of backends.BACKENDS, the quantized and onnx backends always run on the CPU
+def _load_model(state_path, backend="torch", onnx_path=None):
+    classifier = CausalClassifier(2)
+    target = inference.device_for(backend)
+    classifier = classifier.to(target)
+    classifier.load_state_dict(torch.load(state_path, map_location=target))
+    classifier.eval()
+    return backends.prepare(classifier, _classifier_logits, backend,
+                            onnx_path or os.path.splitext(state_path)[0] + ".onnx", state_path)
+
+
+tokenizer = LazyResource(BertTokenizerFast.from_pretrained, pretrained_model_name_or_path=PRE_TRAINED_MODEL_NAME)
+model = LazyResource(_load_model, state_path="./models/causal_classifier.bin")
+session = inference.InferenceSession("classifier", model)
+
+
+# warmup: False, True for inference.WARMUP_LENGTHS or a sequence of token lengths
+def load(warmup=False):
+    tokenizer.load()
+    model.load()
+    if warmup:
+        session.warmup(inference.token_inputs(inference.WARMUP_LENGTHS if warmup is True else warmup,
+                                              token_id=tokenizer.pad_token_id))
 
 
 def get_label(text):
     inputs = tokenizer(text, return_tensors="pt")
-    inputs = inputs.to(device)
-    outputs = model(inputs)
+    outputs = session(inputs["input_ids"], inputs["attention_mask"])
     _, preds = torch.max(outputs, dim=1)
     label = preds.item()
 
     return label
 
+
+# the texts are tokenized once and batched by length, labels are returned in input order
+def get_labels(texts, batch_size=32):
+    labels = [None] * len(texts)
+    if len(texts) == 0:
+        return labels
+    encodings = tokenizer(list(texts), truncation=True)["input_ids"]
+    for bucket in backends.length_buckets([len(ids) for ids in encodings], batch_size):
+        input_ids, attention_mask = backends.pad_batch([encodings[index] for index in bucket], tokenizer.pad_token_id)
+        outputs = session(input_ids, attention_mask)
+        _, preds = torch.max(outputs, dim=1)
+        for index, label in zip(bucket, preds.tolist()):
+            labels[index] = label
+
+    return labels
@@ -1,18 +1,35 @@
-from causal_classifier import get_label
+import causal_classifier
+from causal_classifier import get_label, get_labels
 
 import pytorch_lightning as pl
 import torch
-from transformers import RobertaModel, RobertaTokenizer, BatchEncoding
+from transformers import RobertaModel, RobertaTokenizerFast, BatchEncoding
 from transformers.modeling_outputs import TokenClassifierOutput
 from torch import nn
 from torch.nn import BCEWithLogitsLoss
 import abc
+import os
+import numpy as np
+import backends
+import inference
+from metrics import registry
+from resources import LazyResource
 
 # Configuration variables
 CHECKPOINTS_PATH = '/github/syntactic-constituent-extraction/models/'
 MODEL_NAME = 'roberta_dropout_linear_layer_multilabel'
-USE_GPU = True
+USE_GPU = inference.device_for("torch").type == "cuda"
 MODEL_PATH = CHECKPOINTS_PATH + MODEL_NAME + '.ckpt'
+# optional cheap test run before the BERT classifier, called as PREFILTER(text, tokens) and returning
+# False for sentences that are certainly not causal (see causal_prefilter.LexicalPrefilter)
+PREFILTER = None
+# which model decides whether a sentence is causal: "classifier" asks the BERT classifier before the tagger runs,
+# "tagger" skips the classifier and takes every sentence in which the tagger finds a cause and an effect, so
+# every sentence pays for one encoder pass instead of two (compare both with `evaluate_ce.py single-encoder`)
+GATE = "classifier"
+# with GATE = "tagger": a sentence is also not causal when at least this share of its tokens is tagged
+# NOT_RELEVANT first, None to only require a cause and an effect
+NOT_RELEVANT_THRESHOLD = None
 
 
 class CustomModel(pl.LightningModule):
@@ -39,7 +56,8 @@ class CustomModel(pl.LightningModule):
 
 class MultiLabelRoBERTaCustomModel(CustomModel):
 
-    def get_predictions_from_logits(self, logits):
+    @staticmethod
+    def get_predictions_from_logits(logits):
         sigmoid_outputs = torch.sigmoid(logits)
         predictions = (sigmoid_outputs >= 0.5).int()
 
@@ -102,100 +120,236 @@ LABEL_IDS = [
     'NEGATION',
 ]
 
+# longest input of the tagger in tokens, <s> and </s> included
 MAX_LEN = 80
+# what the tagger does with sentences longer than MAX_LEN: None passes whole sentences to the model, which keeps the
+# results of test/result.txt, "window" tags overlapping windows of MAX_LEN tokens that start WINDOW_STRIDE tokens
+# apart and every token keeps the prediction of the window it is most central in, "truncate" only tags the first
+# MAX_LEN tokens
+OVERFLOW = None
+WINDOW_STRIDE = MAX_LEN // 2
 
 MODEL_NAME = 'roberta_dropout_linear_layer_multilabel'
 DROPOUT = 0.13780087432114646
 
 ############## Parameters related to the BERT model type ###################
 MODEL_TO_USE = 'roberta-base'
-TOKENIZER = RobertaTokenizer.from_pretrained(MODEL_TO_USE)
+TOKENIZER = LazyResource(RobertaTokenizerFast.from_pretrained, pretrained_model_name_or_path=MODEL_TO_USE)
 MODEL_CLASS = MultiLabelRoBERTaCustomModel
 ###########################################################################
 
 
 MODEL_PARAMS = {'dropout': DROPOUT}
 
-model = MODEL_CLASS.load_from_checkpoint(hyperparams=MODEL_PARAMS,
-                                         labels=LABEL_IDS,
-                                         model_to_use=MODEL_TO_USE,
-                                         checkpoint_path=CHECKPOINTS_PATH + MODEL_NAME + '.ckpt')
 
-if USE_GPU:
-    model.cuda()
+def _tagger_logits(tagger, input_ids, attention_mask):
+    return tagger(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=None, labels=None).logits
 
-model.eval()
 
+# backend is one of backends.BACKENDS, the quantized and onnx backends always run on the CPU
+def _load_model(checkpoint_path, backend="torch", onnx_path=None):
+    tagger = MODEL_CLASS.load_from_checkpoint(hyperparams=MODEL_PARAMS,
+                                              labels=LABEL_IDS,
+                                              model_to_use=MODEL_TO_USE,
+                                              checkpoint_path=checkpoint_path,
+                                              map_location="cpu")
+    tagger.to(inference.device_for(backend))
+    tagger.eval()
+    onnx_path = onnx_path or os.path.splitext(checkpoint_path)[0] + ".onnx"
+    return backends.prepare(tagger, _tagger_logits, backend, onnx_path, checkpoint_path)
 
-def convert_tokens_to_string(tokens):
-    output = ''
-    for token in tokens:
-        if token.startswith('Ġ'):
-            output += ' ' + token.replace('Ġ', '')
-        else:
-            output += token
-    return output.strip()
 
+model = LazyResource(_load_model, checkpoint_path=MODEL_PATH)
+session = inference.InferenceSession("tagger", model)
 
-def cause_effect_extraction(text):
-    if get_label(text) == 0:
-        return None
 
-    tokens = TOKENIZER.tokenize(text)
-    inputs = TOKENIZER(text)
-
-    input_ids = torch.tensor([inputs["input_ids"]], dtype=torch.long)
-    attention_mask = torch.tensor([inputs["attention_mask"]], dtype=torch.long)
-
-    if USE_GPU:
-        input_ids = input_ids.cuda()
-        attention_mask = attention_mask.cuda()
-
-    outputs = model(input_ids=input_ids,
-                    attention_mask=attention_mask,
-                    token_type_ids=None,
-                    labels=None
-                    )
-
-    logits = outputs.logits
-    predictions = model.get_predictions_from_logits(logits).cpu()
-
-    cause_tokens = []
-    effect_tokens = []
-    cause_index = [False, False, False]
-    effect_index = [False, False, False]
-    for token_prediction_idx, token_prediction in enumerate(predictions[0][1:-1]):
-        token_predicted_labels = []
-        token = tokens[token_prediction_idx]
-        for label_prediction_idx, label_prediction in enumerate(token_prediction):
-            if label_prediction == 1:
-                token_predicted_labels.append(LABEL_IDS[label_prediction_idx])
-        # token = token.replace("Ġ", "")
-        if token in TOKENIZER.all_special_tokens or len(token_predicted_labels) == 0:
-            continue
-        index = token_predicted_labels[0][-1]
-        if index not in {'1', '2', '3'}:
-            continue
-        index = eval(index)
-        if token_predicted_labels[0].startswith("CAUSE"):
-            if not cause_index[index-1]:
-                cause_tokens.append([token])
-                cause_index[index-1] = True
-            else:
-                cause_tokens[-1].append(token)
-        elif token_predicted_labels[0].startswith("EFFECT"):
-            if not effect_index[index-1]:
-                effect_tokens.append([token])
-                effect_index[index-1] = True
-            else:
-                effect_tokens[-1].append(token)
+# CAUSE_n / EFFECT_n labels as kind 1 / 2 and their number n, 0 for every other label. The extra last entry
+# stands for the label index -1 of tokens without any label.
+SPAN_KINDS = np.array([1 if label.startswith("CAUSE_") else 2 if label.startswith("EFFECT_") else 0
+                       for label in LABEL_IDS] + [0])
+SPAN_NUMBERS = np.array([int(label[-1]) if label[-1] in "123" else 0 for label in LABEL_IDS] + [0])
+NOT_RELEVANT = LABEL_IDS.index('NOT_RELEVANT')
 
-    if len(cause_tokens) == 0 or len(effect_tokens) == 0:
-        return None
-    cause_tokens = [convert_tokens_to_string(tokens) for tokens in cause_tokens]
-    effect_tokens = [convert_tokens_to_string(tokens) for tokens in effect_tokens]
 
-    return {"cause": cause_tokens, "effect": effect_tokens}
+# index of the first predicted label of every token, -1 for tokens without a label
+def first_labels(predictions):
+    return np.where(predictions.any(-1), predictions.argmax(-1), -1)
 
 
-cause_effect_extraction("Chloroplasts are highly dynamic, they circulate and move around within plant cells, and occasionally pinch in two to reproduce.")
+# rebuild the text of a span from the character offsets of its tokens, tokens that follow a space in the
+# original text are separated by a space. Byte-level BPE splits a multi-byte character into several tokens that
+# carry the same offsets, text that is already taken is not repeated.
+def offsets_to_string(text, offsets):
+    pieces = []
+    taken = 0
+    for start, end in offsets:
+        if end <= taken:
+            continue
+        if start < taken:
+            start = taken
+        elif start > 0 and text[start - 1] == ' ':
+            pieces.append(' ')
+        pieces.append(text[start:end])
+        taken = end
+    return ''.join(pieces).strip()
+
+
+# Only the first label of a token counts. The first token with a given CAUSE_n starts a new cause and every
+# later CAUSE token continues the last cause, effects are grouped the same way.
+def _decode_labels(text, ids, offsets, labels):
+    kinds = SPAN_KINDS[labels]
+    kinds[np.isin(ids, TOKENIZER.all_special_ids)] = 0
+    numbers = SPAN_NUMBERS[labels]
+    spans = []
+    for kind in (1, 2):
+        positions = np.flatnonzero(kinds == kind)
+        if len(positions) == 0:
+            return None
+        _, starts = np.unique(numbers[positions], return_index=True)
+        spans.append([offsets_to_string(text, [offsets[position] for position in group])
+                      for group in np.split(positions, np.sort(starts)[1:])])
+
+    return {"cause": spans[0], "effect": spans[1]}
+
+
+# tokens is the optional spaCy parse of text, it is only used by the prefilter
+def cause_effect_extraction(text, tokens=None):
+    if PREFILTER is not None and not PREFILTER(text, tokens):
+        registry.count("ce_gate", outcome="prefilter")
+        return None
+    if GATE == "tagger":
+        with registry.stage("tagger"):
+            result = batch_tag([text], not_relevant=NOT_RELEVANT_THRESHOLD)[0]
+        registry.count("ce_gate", outcome="tagged" if result is not None else "tagger")
+        return result
+
+    with registry.stage("get_label"):
+        label = get_label(text)
+    if label == 0:
+        registry.count("ce_gate", outcome="classifier")
+        return None
+    registry.count("ce_gate", outcome="tagged")
+
+    with registry.stage("tagger"):
+        return batch_tag([text])[0]
+
+
+# batched version of cause_effect_extraction, results are returned in input order
+def batch_cause_effect_extraction(texts, batch_size=32, tokens=None):
+    texts = list(texts)
+    results = [None] * len(texts)
+    candidates = list(range(len(texts)))
+    if PREFILTER is not None:
+        parses = tokens if tokens is not None else [None] * len(texts)
+        candidates = [index for index in candidates if PREFILTER(texts[index], parses[index])]
+    registry.count("ce_gate", len(texts) - len(candidates), outcome="prefilter")
+    if GATE == "tagger":
+        causal = candidates
+        not_relevant = NOT_RELEVANT_THRESHOLD
+    else:
+        with registry.stage("get_label", len(candidates)):
+            labels = get_labels([texts[index] for index in candidates], batch_size)
+        causal = [index for index, label in zip(candidates, labels) if label != 0]
+        not_relevant = None
+        registry.count("ce_gate", len(candidates) - len(causal), outcome="classifier")
+
+    with registry.stage("tagger", len(causal)):
+        spans = batch_tag([texts[index] for index in causal], batch_size, not_relevant)
+    for index, item in zip(causal, spans):
+        results[index] = item
+    if GATE == "tagger":
+        found = sum(1 for item in spans if item is not None)
+        registry.count("ce_gate", len(causal) - found, outcome="tagger")
+        registry.count("ce_gate", found, outcome="tagged")
+    else:
+        registry.count("ce_gate", len(causal), outcome="tagged")
+    return results
+
+
+# cause and effect spans of every text according to the tagger alone, the classifier is not asked. The texts
+# are tokenized once, split into windows following OVERFLOW and batched by length. With not_relevant, texts in
+# which at least that share of the tokens is tagged NOT_RELEVANT first get None.
+def batch_tag(texts, batch_size=32, not_relevant=None):
+    if len(texts) == 0:
+        return []
+    # a single fast tokenizer pass gives the ids, the token strings and their character offsets
+    encodings = TOKENIZER(list(texts), add_special_tokens=False, return_offsets_mapping=True)
+    # (text index, first token, end token) of every window
+    windows = [(index, start, end) for index, ids in enumerate(encodings["input_ids"])
+               for start, end in _windows(len(ids))]
+
+    window_labels = [None] * len(windows)
+    for bucket in backends.length_buckets([end - start for _, start, end in windows], batch_size):
+        sequences = [[TOKENIZER.cls_token_id] + encodings["input_ids"][index][start:end] + [TOKENIZER.sep_token_id]
+                     for index, start, end in (windows[position] for position in bucket)]
+        input_ids, attention_mask = backends.pad_batch(sequences, TOKENIZER.pad_token_id)
+        logits = session(input_ids, attention_mask)
+        labels = first_labels(MODEL_CLASS.get_predictions_from_logits(logits).cpu().numpy())
+        for row, position in enumerate(bucket):
+            _, start, end = windows[position]
+            window_labels[position] = labels[row, 1:1 + end - start]
+
+    results = []
+    position = 0
+    for index, text in enumerate(texts):
+        own = []
+        while position < len(windows) and windows[position][0] == index:
+            own.append((windows[position][1], windows[position][2], window_labels[position]))
+            position += 1
+        labels = _merge_windows(own)
+        length = len(labels)
+        if not_relevant is not None and length > 0 and np.mean(labels == NOT_RELEVANT) >= not_relevant:
+            results.append(None)
+            continue
+        results.append(_decode_labels(text, np.array(encodings["input_ids"][index][:length], dtype=np.int64),
+                                      encodings["offset_mapping"][index][:length], labels))
+
+    return results
+
+
+# (start, end) token ranges of the windows a sentence of `length` tokens (without <s> and </s>) is tagged in
+def _windows(length):
+    limit = MAX_LEN - 2
+    if OVERFLOW is None or length <= limit:
+        return [(0, length)]
+    if OVERFLOW == "truncate":
+        return [(0, limit)]
+    if OVERFLOW != "window":
+        raise ValueError(f"unknown OVERFLOW policy {OVERFLOW!r}, expected 'window', 'truncate' or None")
+    starts = list(range(0, length - limit, min(WINDOW_STRIDE, limit))) + [length - limit]
+    return [(start, start + limit) for start in starts]
+
+
+# join the labels of overlapping windows, the overlap of two windows is split at its middle
+def _merge_windows(windows):
+    if len(windows) == 1:
+        return windows[0][2]
+    parts = []
+    cut = 0
+    for (start, end, labels), following in zip(windows, windows[1:] + [None]):
+        next_cut = end if following is None else (following[0] + end) // 2
+        parts.append(labels[cut - start:next_cut - start])
+        cut = next_cut
+    return np.concatenate(parts)
+
+
+# select the inference backend of both the classifier and the tagger, see backends.BACKENDS
+def set_backend(backend):
+    # a model that already uses the backend is kept, e.g. one loaded before the workers were forked
+    for resource in (causal_classifier.model, model):
+        if resource.options.get("backend", "torch") != backend:
+            resource.configure(backend=backend)
+
+
+# create the classifier and the tagger up front. warmup runs both over batches of inference.WARMUP_LENGTHS
+# tokens, or of the given sequence of lengths, so that the first sentences do not pay for the first calls.
+def load(warmup=True):
+    causal_classifier.load(warmup)
+    TOKENIZER.load()
+    model.load()
+    if warmup:
+        lengths = inference.WARMUP_LENGTHS if warmup is True else warmup
+        # the tagger never sees more than MAX_LEN tokens unless OVERFLOW is None
+        if OVERFLOW is not None:
+            lengths = sorted({min(length, MAX_LEN) for length in lengths})
+        session.warmup(inference.token_inputs(lengths, token_id=TOKENIZER.pad_token_id))
@@ -0,0 +1,53 @@
+import re
+
+# cue words that usually introduce a cause or an effect
+STRONG_CUES = {"if", "because", "since", "when", "whenever", "unless", "once", "therefore", "thus", "hence",
+               "consequently", "so", "due", "cause", "causes", "caused", "causing", "result", "results",
+               "resulted", "lead", "leads", "led", "provided", "otherwise", "until", "after", "before"}
+# cue words that are also common in non-causal sentences
+WEAK_CUES = {"as", "then", "while", "for", "by", "through", "order", "enable", "enables", "allow", "allows",
+             "make", "makes", "trigger", "triggers", "prevent", "prevents"}
+# dependency labels of the parse that mark an adverbial clause or its conjunction
+CLAUSE_DEPS = {"advcl", "mark"}
+
+WORD_PATTERN = re.compile(r"[a-z]+")
+
+
+class LexicalPrefilter:
+    """Cheap test that rejects sentences which are obviously not causal.
+
+    A sentence is scored by summing the weight of every feature it contains:
+    a strong cue word, a weak cue word and, when the spaCy parse is available,
+    an adverbial clause or a subordinating conjunction. Sentences that score
+    below ``threshold`` are rejected before the BERT classifier runs. Lower
+    thresholds keep more of the causal sentences at the cost of running the
+    classifier more often.
+    """
+
+    def __init__(self, threshold=0.5, strong_weight=1.0, weak_weight=0.5, clause_weight=0.5,
+                 strong_cues=None, weak_cues=None):
+        self.threshold = threshold
+        self.strong_weight = strong_weight
+        self.weak_weight = weak_weight
+        self.clause_weight = clause_weight
+        self.strong_cues = STRONG_CUES if strong_cues is None else set(strong_cues)
+        self.weak_cues = WEAK_CUES if weak_cues is None else set(weak_cues)
+
+    def score(self, text, tokens=None):
+        if tokens is not None:
+            words = {tok.lower_ for tok in tokens}
+        else:
+            words = set(WORD_PATTERN.findall(text.lower()))
+
+        score = 0.0
+        if not words.isdisjoint(self.strong_cues):
+            score += self.strong_weight
+        if not words.isdisjoint(self.weak_cues):
+            score += self.weak_weight
+        if tokens is not None and any(tok.dep_ in CLAUSE_DEPS for tok in tokens):
+            score += self.clause_weight
+        return score
+
+    # True when the sentence may be causal and has to go through the classifier
+    def __call__(self, text, tokens=None):
+        return self.score(text, tokens) >= self.threshold
@@ -0,0 +1,80 @@
+import os
+import pickle
+
+# version of the precompiled index format, bump it when the layout changes
+INDEX_VERSION = 1
+# largest number of words allowed on each side of the head word
+MAX_LEFT = 1
+MAX_RIGHT = 2
+
+
+class CollocationIndex:
+    """Collocation n-grams keyed by head word.
+
+    Every n-gram is stored under each of its words that can act as the head of a
+    (left, head, right) expansion, so all candidate expansions of a verb are
+    answered with a single dictionary lookup.
+    """
+
+    def __init__(self, entries=None):
+        # head word -> frozenset of (left, right) pairs
+        self.entries = entries if entries is not None else {}
+
+    @classmethod
+    def from_lines(cls, lines):
+        entries = {}
+        for line in lines:
+            words = line.split(' ')
+            for position, word in enumerate(words):
+                if position > MAX_LEFT or len(words) - position - 1 > MAX_RIGHT:
+                    continue
+                pair = (' '.join(words[:position]), ' '.join(words[position + 1:]))
+                entries.setdefault(word, set()).add(pair)
+        return cls({word: frozenset(pairs) for word, pairs in entries.items()})
+
+    @classmethod
+    def from_text(cls, path):
+        with open(path, "r", encoding='utf-8') as f:
+            return cls.from_lines(f.read().splitlines())
+
+    # Load the precompiled index next to the text file, build and save it if it is missing or stale. The index is
+    # used on its own when only the index is shipped. It is a pickle, so only load index files from a trusted source.
+    @classmethod
+    def load(cls, path, index_path=None):
+        index_path = index_path or os.path.splitext(path)[0] + ".idx"
+        if os.path.exists(index_path) and (not os.path.exists(path) or
+                                           os.path.getmtime(index_path) >= os.path.getmtime(path)):
+            with open(index_path, "rb") as f:
+                version, entries = pickle.load(f)
+            if version == INDEX_VERSION:
+                return cls(entries)
+        index = cls.from_text(path)
+        try:
+            index.save(index_path)
+        except OSError:
+            pass
+        return index
+
+    def save(self, index_path):
+        with open(index_path, "wb") as f:
+            pickle.dump((INDEX_VERSION, self.entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __contains__(self, phrase):
+        words = phrase.split(' ')
+        for position, word in enumerate(words):
+            if position > MAX_LEFT or len(words) - position - 1 > MAX_RIGHT:
+                continue
+            pair = (' '.join(words[:position]), ' '.join(words[position + 1:]))
+            return pair in self.entries.get(word, ())
+        return False
+
+    # return the first (left, right) candidate pair that forms a collocation with head, or None
+    def match(self, head, lefts, rights):
+        pairs = self.entries.get(head)
+        if pairs is None:
+            return None
+        for left in lefts:
+            for right in rights:
+                if (left, right) in pairs:
+                    return left, right
+        return None
@@ -0,0 +1,64 @@
+from spacy.language import Language
+from spacy.tokens import Doc
+
+from array_engine import ArrayAnalysis
+from extract import DocumentAnalysis, nlp
+from resources import LazyResource
+
+# rule engines the component can run, see pipeline.ANALYSIS
+ENGINES = {"token": DocumentAnalysis, "array": ArrayAnalysis}
+
+for _name in ("svos", "sms", "vms"):
+    if not Doc.has_extension(_name):
+        Doc.set_extension(_name, default=None)
+
+
+class RelationExtractor:
+    """spaCy component that stores the SVOs, SMs and VMs of a Doc in ``doc._.svos``, ``doc._.sms`` and
+    ``doc._.vms``, so that the rules run inside ``nlp.pipe`` next to the parser.
+
+    With ``coref`` every Doc is resolved with coref.coref_chains first, which loads the
+    coreference model in every process of ``nlp.pipe(n_process=...)``.
+    """
+
+    def __init__(self, engine="token", coref=False):
+        self.engine = engine
+        self.coref = coref
+
+    def __call__(self, doc):
+        chains = None
+        if self.coref:
+            from coref import coref_chains
+            chains = coref_chains(doc.text)
+        doc._.svos, doc._.sms, doc._.vms = ENGINES[self.engine](doc, chains).relations()
+        return doc
+
+
+@Language.factory("relation_extractor", default_config={"engine": "token", "coref": False})
+def create_relation_extractor(nlp, name, engine, coref):
+    if engine not in ENGINES:
+        raise ValueError(f"unknown engine {engine!r}, expected one of {sorted(ENGINES)}")
+    return RelationExtractor(engine, coref)
+
+
+# the (svos, sms, vms) of a Doc processed by the component. Docs that come back from other processes of
+# nlp.pipe(n_process=...) are serialized on the way, which turns the relation tuples into lists; they are
+# turned back into tuples here.
+def relations(doc):
+    return ([tuple(svo) for svo in doc._.svos], [tuple(sm) for sm in doc._.sms],
+            [tuple(vm) for vm in doc._.vms])
+
+
+# a pipeline like extract.nlp with the relation extractor as its last component. The tokenizer and the components
+# are the ones of extract.nlp, so both pipelines share the vocab and the weights instead of loading the model twice.
+def _load_relation_nlp(engine="token", coref=False):
+    source = nlp.get()
+    relation_nlp = type(source)(vocab=source.vocab, meta=dict(source.meta))
+    relation_nlp.tokenizer = source.tokenizer
+    for name in source.pipe_names:
+        relation_nlp.add_pipe(name, source=source)
+    relation_nlp.add_pipe("relation_extractor", config={"engine": engine, "coref": coref})
+    return relation_nlp
+
+
+relation_nlp = LazyResource(_load_relation_nlp)
@@ -1,31 +1,135 @@
-import sys
-sys.path.append('fast_coref/')
-from fast_coref.inference.model_inference import Inference
 import string
+import inference
+from resources import LazyResource
 
 
-inference_model = Inference("./models", encoder_name="shtoshni/longformer_coreference_ontonotes")
+def _load_inference(model_path, encoder_name, fast_coref_path='fast_coref/'):
+    import sys
+    if fast_coref_path not in sys.path:
+        sys.path.append(fast_coref_path)
+    from fast_coref.inference.model_inference import Inference
+    return Inference(model_path, encoder_name=encoder_name)
+
+
+inference_model = LazyResource(_load_inference, model_path="./models",
+                               encoder_name="shtoshni/longformer_coreference_ontonotes")
+# fast_coref places the longformer on the GPU itself when there is one. Its own post-processing may change the
+# output tensors in place, which inference tensors do not allow, so the calls run under no_grad.
+session = inference.InferenceSession("coref", inference_model, method="perform_coreference", inference_mode=False)
 
 PRON = {"he", "him", "she", "her", "it", "they", "them", "i", "me", "we", "us"}
 
+WARMUP_WORDS = "The committee approved the plan because it reduced the costs that they had reported .".split()
+
+
+# create the longformer up front. warmup resolves texts of inference.WARMUP_LENGTHS words, or of the given
+# sequence of lengths, so that the first sentences do not pay for the first calls.
+def load(warmup=True):
+    inference_model.load()
+    if warmup:
+        lengths = inference.WARMUP_LENGTHS if warmup is True else warmup
+        session.warmup((" ".join(WARMUP_WORDS[index % len(WARMUP_WORDS)] for index in range(length)),)
+                       for length in lengths)
+
 
 class coref_chains:
     def __init__(self, text):
-        self.output = inference_model.perform_coreference(text)
-        self.clusters = []
-        for cluster in self.output["subtoken_idx_clusters"]:
-            temp = set()
-            for element in cluster:
-                possible_index = self.output["tokenized_doc"]["subtoken_map"][element[-1]]
-                while self.output["tokenized_doc"]["orig_tokens"][possible_index] in string.punctuation:
-                    possible_index -= 1
-                temp.add(possible_index)
-            self.clusters.append(temp)
+        output = session(text)
+        orig_tokens = output["tokenized_doc"]["orig_tokens"]
+        # token index -> index of the representative mention of the first cluster that has one, the raw model
+        # output is not kept
+        self.representatives = {}
+        for cluster in _cluster_indices(output):
+            representative = _representative(cluster, orig_tokens)
+            if representative is None:
+                continue
+            for index in cluster:
+                self.representatives.setdefault(index, representative)
 
     def resolve(self, item):
-        for i in range(len(self.clusters)):
-            if item.i in self.clusters[i]:
-                for index in self.clusters[i]:
-                    if self.output["tokenized_doc"]["orig_tokens"][index].lower() not in PRON:
-                        return index
-        return None
+        return self.representatives.get(item.i)
+
+    # the token of the sentence that item refers to, or None
+    def resolve_token(self, item):
+        index = self.representatives.get(item.i)
+        if index is None:
+            return None
+        return item.doc[index]
+
+
+# coreference of one sentence that was resolved together with its neighbours, an antecedent may be a token of
+# a previous or following sentence
+class window_chains:
+    def __init__(self, representatives):
+        # token index in the sentence -> representative Token
+        self.representatives = representatives
+
+    def resolve_token(self, item):
+        return self.representatives.get(item.i)
+
+
+# original token index of the last token of every mention, grouped by cluster
+def _cluster_indices(output):
+    clusters = []
+    for cluster in output["subtoken_idx_clusters"]:
+        temp = set()
+        for element in cluster:
+            possible_index = output["tokenized_doc"]["subtoken_map"][element[-1]]
+            while output["tokenized_doc"]["orig_tokens"][possible_index] in string.punctuation:
+                possible_index -= 1
+            temp.add(possible_index)
+        clusters.append(temp)
+    return clusters
+
+
+# the first mention of a cluster that is not a pronoun
+def _representative(cluster, orig_tokens):
+    for index in cluster:
+        if orig_tokens[index].lower() not in PRON:
+            return index
+    return None
+
+
+# Resolve the coreference of parsed sentences that follow each other in a document. The longformer runs once
+# per `stride` sentences over a window of the last `window` sentences, so every pass is shared by several
+# sentences and pronouns can be resolved to an antecedent in an earlier sentence. `context` holds the parsed
+# sentences that come right before `docs`, they are only used as antecedents. Returns one window_chains per doc.
+def windowed_coref(docs, window=8, stride=4, context=()):
+    context = list(context)
+    docs = context + list(docs)
+    resolvers = []
+    owned_from = len(context)
+    while owned_from < len(docs):
+        end = min(owned_from + stride, len(docs))
+        start = max(0, end - window)
+        resolvers.extend(_resolve_window(docs[start:end], owned_from - start))
+        owned_from = end
+    return resolvers
+
+
+# resolve docs together and return a window_chains for every doc from index `first_owned` on
+def _resolve_window(docs, first_owned):
+    owned = docs[first_owned:]
+    representatives = {id(doc): {} for doc in owned}
+    # spaCy tokens in the order of the original tokens of the coreference model
+    positions = []
+    sentences = []
+    for doc in docs:
+        tokens = [tok for tok in doc if not tok.is_space]
+        if len(tokens) > 0:
+            positions.extend(tokens)
+            sentences.append([tok.text for tok in tokens])
+
+    if len(sentences) > 0:
+        output = session(sentences)
+        orig_tokens = output["tokenized_doc"]["orig_tokens"]
+        for cluster in _cluster_indices(output):
+            representative = _representative(cluster, orig_tokens)
+            if representative is None:
+                continue
+            for index in cluster:
+                token = positions[index]
+                if id(token.doc) in representatives:
+                    representatives[id(token.doc)].setdefault(token.i, positions[representative])
+
+    return [window_chains(representatives[id(doc)]) for doc in owned]
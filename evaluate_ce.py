@@ -0,0 +1,167 @@
+import argparse
+import sys
+import time
+
+import causal_extractor
+from backends import BACKENDS
+from extract import nlp
+from causal_classifier import get_labels
+from causal_prefilter import LexicalPrefilter
+
+
+def _read_corpus(path):
+    with open(path, "r", encoding='utf-8') as f:
+        return [line for line in f.read().splitlines() if line.strip()]
+
+
+# compare the prefilter with the BERT classifier at several thresholds, the classifier labels are the reference
+def evaluate_prefilter(texts, thresholds, batch_size=32):
+    labels = get_labels(texts, batch_size)
+    prefilter = LexicalPrefilter()
+    scores = [prefilter.score(text, tokens) for text, tokens in zip(texts, nlp.pipe(texts, batch_size=batch_size))]
+    causal = sum(1 for label in labels if label != 0)
+
+    rows = []
+    for threshold in thresholds:
+        passed = [score >= threshold for score in scores]
+        kept = sum(passed)
+        true_positives = sum(1 for keep, label in zip(passed, labels) if keep and label != 0)
+        rows.append({
+            "threshold": threshold,
+            "passed": kept,
+            "rejected": len(texts) - kept,
+            "recall": true_positives / causal if causal else 1.0,
+            "precision": true_positives / kept if kept else 1.0,
+        })
+    return {"sentences": len(texts), "causal": causal, "rows": rows}
+
+
+def _print_prefilter_report(report):
+    print(f"sentences: {report['sentences']}, causal according to the classifier: {report['causal']}")
+    print(f"{'threshold':>9} {'passed':>8} {'rejected':>8} {'recall':>8} {'precision':>9}")
+    for row in report["rows"]:
+        print(f"{row['threshold']:>9.2f} {row['passed']:>8} {row['rejected']:>8} "
+              f"{row['recall']:>8.3f} {row['precision']:>9.3f}")
+
+
+# run the CE stage with every backend and compare decisions and spans with the fp32 torch backend
+def evaluate_backends(texts, backends, batch_size=32, repeat=3):
+    reports = []
+    reference = None
+    for backend in ["torch"] + [backend for backend in backends if backend != "torch"]:
+        causal_extractor.set_backend(backend)
+        causal_extractor.load()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results = causal_extractor.batch_cause_effect_extraction(texts, batch_size)
+            timings.append(time.perf_counter() - start)
+        if reference is None:
+            reference = results
+        decisions = sum(1 for result, expected in zip(results, reference) if (result is None) == (expected is None))
+        spans = sum(1 for result, expected in zip(results, reference) if result == expected)
+        reports.append({
+            "backend": backend,
+            "decision_agreement": decisions / len(texts),
+            "span_agreement": spans / len(texts),
+            "ms_per_sentence": min(timings) / len(texts) * 1000,
+        })
+    causal_extractor.set_backend("torch")
+    return reports
+
+
+def _print_backend_report(reports):
+    print(f"{'backend':>10} {'decisions':>10} {'spans':>8} {'ms/sentence':>12}")
+    for report in reports:
+        print(f"{report['backend']:>10} {report['decision_agreement']:>10.3f} {report['span_agreement']:>8.3f} "
+              f"{report['ms_per_sentence']:>12.2f}")
+
+
+# compare the tagger-only gate (GATE = "tagger") at several NOT_RELEVANT thresholds with the two-model path,
+# which is the reference for the causal decisions and the spans
+def evaluate_single_encoder(texts, thresholds, batch_size=32, repeat=3):
+    gate, threshold = causal_extractor.GATE, causal_extractor.NOT_RELEVANT_THRESHOLD
+    causal_extractor.load()
+    reports = []
+    reference = None
+    try:
+        for mode, value in [("classifier", None)] + [("tagger", value) for value in thresholds]:
+            causal_extractor.GATE, causal_extractor.NOT_RELEVANT_THRESHOLD = mode, value
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                results = causal_extractor.batch_cause_effect_extraction(texts, batch_size)
+                timings.append(time.perf_counter() - start)
+            if reference is None:
+                reference = results
+            causal = sum(1 for expected in reference if expected is not None)
+            found = sum(1 for result in results if result is not None)
+            both = sum(1 for result, expected in zip(results, reference) if result is not None and expected is not None)
+            reports.append({
+                "gate": mode if value is None else f"{mode}@{value:g}",
+                "causal": found,
+                "decision_agreement": sum(1 for result, expected in zip(results, reference)
+                                          if (result is None) == (expected is None)) / len(texts),
+                "recall": both / causal if causal else 1.0,
+                "precision": both / found if found else 1.0,
+                "span_agreement": sum(1 for result, expected in zip(results, reference)
+                                      if result is not None and result == expected) / both if both else 1.0,
+                "ms_per_sentence": min(timings) / len(texts) * 1000,
+            })
+    finally:
+        causal_extractor.GATE, causal_extractor.NOT_RELEVANT_THRESHOLD = gate, threshold
+    return reports
+
+
+def _print_single_encoder_report(reports):
+    print(f"{'gate':>16} {'causal':>7} {'decisions':>10} {'recall':>7} {'precision':>9} {'spans':>6} "
+          f"{'ms/sentence':>12}")
+    for report in reports:
+        print(f"{report['gate']:>16} {report['causal']:>7} {report['decision_agreement']:>10.3f} "
+              f"{report['recall']:>7.3f} {report['precision']:>9.3f} {report['span_agreement']:>6.3f} "
+              f"{report['ms_per_sentence']:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the cause-and-effect extraction stage.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prefilter_parser = subparsers.add_parser("prefilter", help="recall / precision of the lexical prefilter "
+                                                               "against the BERT classifier")
+    prefilter_parser.add_argument("--corpus", default="test/sample.txt", help="one sentence per line")
+    prefilter_parser.add_argument("--thresholds", type=float, nargs="+", default=[0.5, 1.0, 1.5, 2.0])
+    prefilter_parser.add_argument("--batch-size", type=int, default=32)
+
+    backends_parser = subparsers.add_parser("backends", help="accuracy parity and latency of the CPU inference "
+                                                             "backends against fp32 torch")
+    backends_parser.add_argument("--corpus", default="test/sample.txt", help="one sentence per line")
+    backends_parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    backends_parser.add_argument("--batch-size", type=int, default=32)
+    backends_parser.add_argument("--repeat", type=int, default=3, help="timed runs per backend, the fastest is kept")
+    backends_parser.add_argument("--min-agreement", type=float, default=0.95,
+                                 help="fail when a backend agrees with fp32 on fewer decisions than this")
+
+    single_parser = subparsers.add_parser("single-encoder", help="decisions, spans and latency of the tagger-only "
+                                                                 "gate against the classifier + tagger path")
+    single_parser.add_argument("--corpus", default="test/sample.txt", help="one sentence per line")
+    single_parser.add_argument("--thresholds", type=float, nargs="*", default=[],
+                               help="NOT_RELEVANT thresholds to try in addition to requiring a cause and an effect")
+    single_parser.add_argument("--batch-size", type=int, default=32)
+    single_parser.add_argument("--repeat", type=int, default=3, help="timed runs per gate, the fastest is kept")
+
+    args = parser.parse_args()
+    texts = _read_corpus(args.corpus)
+    if args.command == "prefilter":
+        _print_prefilter_report(evaluate_prefilter(texts, args.thresholds, args.batch_size))
+    elif args.command == "backends":
+        reports = evaluate_backends(texts, args.backends, args.batch_size, args.repeat)
+        _print_backend_report(reports)
+        if any(report["decision_agreement"] < args.min_agreement for report in reports):
+            sys.exit(1)
+    elif args.command == "single-encoder":
+        _print_single_encoder_report(evaluate_single_encoder(texts, [None] + args.thresholds, args.batch_size,
+                                                             args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,18 @@
-import en_core_web_sm
 from collections.abc import Iterable
+from collocation import CollocationIndex
+from resources import LazyResource
 
-# use spacy small model
-nlp = en_core_web_sm.load()
 
-with open("pmi-masking/pmi-wiki-bc.txt", "r", encoding='utf-8') as f:
-    collocation = f.read().splitlines()
+def _load_nlp(**kwargs):
+    import en_core_web_sm
+    return en_core_web_sm.load(**kwargs)
+
+
+# use spacy small model, loaded on first use. The rules read the tags, lemmas and the dependency parse, the
+# entity recognizer is not loaded.
+nlp = LazyResource(_load_nlp, exclude=["ner"])
+
+collocation = LazyResource(CollocationIndex.load, path="pmi-masking/pmi-wiki-bc.txt")
 
 # dependency markers for subjects
 SUBJECTS = {"nsubj", "nsubjpass", "csubj", "csubjpass", "agent", "expl"}
@@ -62,10 +69,13 @@ def _get_objs_from_conjunctions(objs):
     return more_objs
 
 
-# find sub dependencies
+# find sub dependencies. A verb list without a center verb heads the sentence (e.g. an imperative), there is
+# nothing above it to take a subject from, so it has no subjects.
 def _find_subs(toks):
     if type(toks).__name__ == "list":
         tok = get_center_verb(toks)
+        if tok is None:
+            return [], False
         head = tok.head
     else:
         head = toks.head
@@ -257,43 +267,65 @@ def expand(item, tokens, visited, isfirst=False):
     if isfirst and item.i in visited:
         return []
 
-    parts = []
+    return _expand_span(item, visited)
 
-    if hasattr(item, 'lefts'):
-        for part in item.lefts:
-            if part.pos_ in BREAKER_POS and part.dep_ not in SPECIAL_VERB_DEPS or part.i in visited:
-                break
-            if not part.lower_ in NEGATIONS:
-                if hasattr(part, 'lefts'):
-                    for item2 in part.lefts:
-                        if item2.i not in visited:
-                            visited.add(item2.i)
-                            parts.extend(expand(item2, tokens, visited))
-                parts.append(part)
-                if hasattr(part, 'rights'):
-                    for item2 in part.rights:
-                        if item2.i not in visited:
-                            visited.add(item2.i)
-                            parts.extend(expand(item2, tokens, visited))
 
-    parts.append(item)
+# actions of _expand_span: look at the next child on one side of a token, add a token to the span, and look at
+# the next child on one side of a part
+SCAN, EMIT, CHILD = 0, 1, 2
 
-    if hasattr(item, 'rights'):
-        for part in item.rights:
-            if part.pos_ in BREAKER_POS and part.dep_ not in SPECIAL_VERB_DEPS or part.i in visited:
-                break
-            if not part.lower_ in NEGATIONS:
-                if hasattr(part, 'lefts'):
-                    for item2 in part.lefts:
-                        if item2.i not in visited:
-                            visited.add(item2.i)
-                            parts.extend(expand(item2, tokens, visited))
+
+# The span expansion shared by expand, get_subject and get_modifier. The left children of item, item and its
+# right children are taken in order until a breaker or, with check_visited, a visited token; negations are left
+# out. A part brings its left children, itself and its right children, every child that is not visited yet is
+# marked visited and expanded like expand(child) does, or only marked with mark_only. An explicit stack instead
+# of recursion keeps long sentences within the recursion limit and leaves are added without being pushed.
+def _expand_span(item, visited, lefts=True, emit_item=True, rights=True, check_visited=True, mark_only=False):
+    parts = []
+    stack = []
+    if rights:
+        stack.append((SCAN, item.rights, check_visited, mark_only))
+    if emit_item:
+        stack.append((EMIT, item))
+    if lefts:
+        stack.append((SCAN, item.lefts, check_visited, mark_only))
+
+    while stack:
+        action = stack.pop()
+        if action[0] == EMIT:
+            parts.append(action[1])
+        elif action[0] == SCAN:
+            _, children, check, mark = action
+            part = next(children, None)
+            if part is None or part.pos_ in BREAKER_POS and part.dep_ not in SPECIAL_VERB_DEPS or \
+                    check and part.i in visited:
+                continue
+            stack.append(action)
+            if part.lower_ in NEGATIONS:
+                continue
+            if part.n_lefts == 0 and part.n_rights == 0:
                 parts.append(part)
-                if hasattr(part, 'rights'):
-                    for item2 in part.rights:
-                        if item2.i not in visited:
-                            visited.add(item2.i)
-                            parts.extend(expand(item2, tokens, visited))
+                continue
+            stack.append((CHILD, part.rights, mark))
+            stack.append((EMIT, part))
+            stack.append((CHILD, part.lefts, mark))
+        else:
+            _, children, mark = action
+            child = next(children, None)
+            if child is None:
+                continue
+            stack.append(action)
+            if child.i in visited:
+                continue
+            visited.add(child.i)
+            if mark:
+                continue
+            if child.n_lefts == 0 and child.n_rights == 0:
+                parts.append(child)
+                continue
+            stack.append((SCAN, child.rights, True, False))
+            stack.append((EMIT, child))
+            stack.append((SCAN, child.lefts, True, False))
 
     return parts
 
@@ -321,7 +353,7 @@ def _get_verb_advmod(item):
         return ' ' + list(item.rights)[0].lemma_
 
 
-def _process_relative_word_and_pron(items, tokens, visited, coref=None):
+def _process_relative_word_and_pron(items, visited, coref=None):
     objs = []
     for item in items:
         if item.lemma_ in RELATIVE_WORDS and (
@@ -330,9 +362,9 @@ def _process_relative_word_and_pron(items, tokens, visited, coref=None):
             visited.add(item.head.i)
             objs.append(item.head.head)
         elif coref is not None and item.pos_ == "PRON":
-            result = coref.resolve(item)
+            result = coref.resolve_token(item)
             if result is not None:
-                objs.append(list(tokens)[result])
+                objs.append(result)
             else:
                 objs.append(item)
         else:
@@ -348,121 +380,53 @@ def get_center_verb(v_list):
 
 
 def expand_verb(verb):
+    verb_lefts = list(verb.lefts)
+    verb_rights = list(verb.rights)
 
-    if len(list(verb.lefts)) == 0:
+    if len(verb_lefts) == 0:
         lefts = ['']
-    elif list(verb.lefts)[-1].pos_ not in {"NOUN", "PROPN", "PRON", "DET"}:
-        lefts = ['', list(verb.lefts)[-1].text.lower()]
+    elif verb_lefts[-1].pos_ not in {"NOUN", "PROPN", "PRON", "DET"}:
+        lefts = ['', verb_lefts[-1].text.lower()]
     else:
         lefts = ['']
 
-    if len(list(verb.rights)) == 0 or verb.pos_ == "AUX":
+    if len(verb_rights) == 0 or verb.pos_ == "AUX":
         rights = ['']
-    elif len(list(verb.rights)) == 1:
-        rights = ['', list(verb.rights)[0].text.lower()]
+    elif len(verb_rights) == 1:
+        rights = ['', verb_rights[0].text.lower()]
     else:
-        rights = ['', list(verb.rights)[0].text.lower(),
-                  list(verb.rights)[0].text.lower() + ' ' + list(verb.rights)[1].text.lower()]
-
-    for left in lefts[::-1]:
-        for right in rights[::-1]:
-            if (left + ' ' + verb.text.lower() + ' ' + right).strip() in collocation:
-                expanded = []
-                if left != '':
-                    expanded.append(list(verb.lefts)[-1])
-                expanded.append(verb)
-                if right != '':
-                    if ' ' in right:
-                        expanded.append(list(verb.rights)[0])
-                        expanded.append(list(verb.rights)[1])
-                    else:
-                        expanded.append(list(verb.rights)[0])
-                return expanded
-
-    if len(list(verb.lefts)) > 1 and list(verb.lefts)[-1].dep_ == "neg":
-        return [list(verb.lefts)[-1], verb]
+        rights = ['', verb_rights[0].text.lower(),
+                  verb_rights[0].text.lower() + ' ' + verb_rights[1].text.lower()]
+
+    matched = collocation.match(verb.text.lower(), lefts[::-1], rights[::-1])
+    if matched is not None:
+        left, right = matched
+        expanded = []
+        if left != '':
+            expanded.append(verb_lefts[-1])
+        expanded.append(verb)
+        if right != '':
+            if ' ' in right:
+                expanded.append(verb_rights[0])
+                expanded.append(verb_rights[1])
+            else:
+                expanded.append(verb_rights[0])
+        return expanded
+
+    if len(verb_lefts) > 1 and verb_lefts[-1].dep_ == "neg":
+        return [verb_lefts[-1], verb]
 
     return [verb]
 
 
 # find verbs and their subjects / objects to create SVOs, detect passive/active sentences
 def findSVOs(tokens, coref=None):
-    svos = []
-    # passive_verbs = _get_passive_verbs(tokens)
-    verbs = _find_verbs(tokens)
-    for v in verbs:
-        expanded_verb = expand_verb(v)
-        visited = set()
-        for verb in expanded_verb:
-            visited.add(verb.i)
-        subs, verbNegated = _get_all_subs(expanded_verb)
-        # hopefully there are subs, if not, don't examine this verb any longer
-        if len(subs) > 0:
-            isConjVerb, conjV = _right_of_verb_is_conj_verb(expanded_verb)
-            if isConjVerb:
-                # is_pas = conjV in passive_verbs
-                v2, objs = _get_all_objs(conjV, visited, False)
-                for sub in subs:
-                    sub, visited = _process_relative_word_and_pron([sub], list(tokens), visited, coref)
-                    sub = sub[0]
-                    if len(objs) > 0:
-                        # objNegated = _is_negated(obj)
-                        objs, visited = _process_relative_word_and_pron(objs, list(tokens), visited, coref)
-
-                        svos.append((to_str(get_subject(sub, tokens, visited)),
-                                     "!" + to_str(expanded_verb) if verbNegated else to_str(
-                                         expanded_verb),
-                                     to_str(multi_expand(objs, tokens, visited, True))))
-                        svos.append((to_str(get_subject(sub, tokens, visited)),
-                                     "!" + to_str(v2) if verbNegated else to_str(v2),
-                                     to_str(multi_expand(objs, tokens, visited, True))))
-                    else:
-                        svos.append((to_str(get_subject(sub, tokens, visited)),
-                                     "!" + to_str(expanded_verb) if verbNegated else to_str(expanded_verb),))
-            else:
-                # is_pas = v in passive_verbs
-                v, objs = _get_all_objs(expanded_verb, visited, False)
-                for sub in subs:
-                    sub, visited = _process_relative_word_and_pron([sub], list(tokens), visited, coref)
-                    sub = sub[0]
-                    if len(objs) > 0:
-                        # objNegated = _is_negated(obj)
-                        objs, visited = _process_relative_word_and_pron(objs, list(tokens), visited, coref)
-
-                        svos.append((to_str(get_subject(sub, tokens, visited)),
-                                     "!" + to_str(v) if verbNegated else to_str(v),
-                                     to_str(multi_expand(objs, tokens, visited, True))))
-                    else:
-                        # no obj - just return the SV parts
-                        svos.append((to_str(get_subject(sub, tokens, visited)),
-                                     "!" + to_str(v) if verbNegated else to_str(v),))
-
-    return svos
+    return DocumentAnalysis(tokens, coref).svos()
 
 
 def get_subject(item, tokens, visited):
-    parts = []
-
-    if hasattr(item, 'lefts'):
-        for part in item.lefts:
-            if part.pos_ in BREAKER_POS and part.dep_ not in SPECIAL_VERB_DEPS:
-                break
-            if not part.lower_ in NEGATIONS:
-                if hasattr(part, 'lefts'):
-                    for item2 in part.lefts:
-                        if item2.i not in visited:
-                            visited.add(item2.i)
-                            parts.extend(expand(item2, tokens, visited, True))
-                parts.append(part)
-                if hasattr(part, 'rights'):
-                    for item2 in part.rights:
-                        if item2.i not in visited:
-                            visited.add(item2.i)
-                            parts.extend(expand(item2, tokens, visited, True))
-
-    parts.append(item)
-
-    return parts
+    # unlike expand, visited tokens do not stop the lefts and the children of the parts are only marked visited
+    return _expand_span(item, visited, rights=False, check_visited=False, mark_only=True)
 
 
 def get_modifier(item, tokens, visited):
@@ -471,46 +435,12 @@ def get_modifier(item, tokens, visited):
         if temp_item is not None:
             item = temp_item
 
-    parts = []
-
-    if hasattr(item, 'rights'):
-        for part in item.rights:
-            if part.pos_ in BREAKER_POS and part.dep_ not in SPECIAL_VERB_DEPS:
-                break
-            if not part.lower_ in NEGATIONS:
-                if hasattr(part, 'lefts'):
-                    for item2 in part.lefts:
-                        if item2.i not in visited:
-                            visited.add(item2.i)
-                            parts.extend(expand(item2, tokens, visited))
-                parts.append(part)
-                if hasattr(part, 'rights'):
-                    for item2 in part.rights:
-                        if item2.i not in visited:
-                            visited.add(item2.i)
-                            parts.extend(expand(item2, tokens, visited))
-
-    return parts
+    return _expand_span(item, visited, lefts=False, emit_item=False, check_visited=False)
 
 
 # find subjects and their modifiers to create SMs
 def findSMs(tokens, coref=None):
-    sms = set()
-    verbs = _find_verbs(tokens)
-    for v in verbs:
-        expanded_verb = expand_verb(v)
-        visited = set()
-        for verb in expanded_verb:
-            visited.add(verb.i)
-        subs, verbNegated = _get_all_subs(expanded_verb)
-        # hopefully there are subs, if not, don't examine this verb any longer
-        if len(subs) > 0:
-            for sub in subs:
-                sub, visited = _process_relative_word_and_pron([sub], list(tokens), visited, coref)
-                sub = sub[0]
-                sms.add((to_str(get_subject(sub, tokens, visited)), to_str(get_modifier(sub, tokens, visited))))
-
-    return list(sms)
+    return DocumentAnalysis(tokens, coref).sms()
 
 
 def _split_mods(tokens):
@@ -562,26 +492,129 @@ def get_children_of_verb(v_list):
     return children
 
 
-# find subjects and their modifiers to create SMs
+# find verbs and their modifiers to create VMs
 def findVMs(tokens):
-    vms = []
-    verbs = _find_verbs(tokens)
-    for v in verbs:
-        expanded_verb = expand_verb(v)
-        visited = set()
-        for verb in expanded_verb:
-            visited.add(verb.i)
-        children = get_children_of_verb(expanded_verb)
-        p_mods = _get_mods_from_prepositions(children, tokens, visited)
-        c_mods = _get_mods_from_clauses(children, tokens, visited)
-        i_mods = _get_mods_from_inf(children, tokens, visited)
-        if len(p_mods) > 0:
-            vms.append((to_str(expanded_verb), [to_str(p_mod) for p_mod in p_mods]))
-        elif len(c_mods) > 0:
-            vms.append((to_str(expanded_verb), [to_str(c_mod) for c_mod in c_mods]))
-        elif len(i_mods) > 0:
-            vms.append((to_str(expanded_verb), [to_str(i_mod) for i_mod in i_mods]))
-        else:
-            vms.append((to_str(expanded_verb), ''))
+    return DocumentAnalysis(tokens).vms()
+
+
+# verbs, expanded verbs, subjects and children of a parsed sentence, computed once and shared
+# by the SVO, SM and VM rules
+class DocumentAnalysis:
+    def __init__(self, tokens, coref=None):
+        self.tokens = tokens
+        self._doc = getattr(tokens, "doc", tokens)
+        self.coref = coref
+        self.verbs = []
+        for v in _find_verbs(tokens):
+            expanded_verb = expand_verb(v)
+            subs, verb_negated = _get_all_subs(expanded_verb)
+            self.verbs.append((expanded_verb, subs, verb_negated, get_children_of_verb(expanded_verb)))
+
+    def relations(self):
+        return self.svos(), self.sms(), self.vms()
+
+    # The visited set to expand token with. Windowed coreference can resolve a subject or object to a token of
+    # an earlier sentence, whose indices mean other tokens than those of this sentence, so every other sentence
+    # gets its own set in `foreign` instead of sharing `visited`.
+    def _visited(self, token, visited, foreign):
+        if token.doc is self._doc:
+            return visited
+        return foreign.setdefault(id(token.doc), set())
+
+    def _subject(self, sub, visited, foreign):
+        return to_str(get_subject(sub, self.tokens, self._visited(sub, visited, foreign)))
+
+    def _modifier(self, sub, visited, foreign):
+        # get_modifier replaces "that" by a token of this sentence
+        if sub.lower_ == 'that' and _get_that_resolution(self.tokens) is not None:
+            return to_str(get_modifier(sub, self.tokens, visited))
+        return to_str(get_modifier(sub, self.tokens, self._visited(sub, visited, foreign)))
+
+    def _objects(self, objs, visited, foreign):
+        parts = []
+        for obj in objs:
+            parts.extend(expand(obj, self.tokens, self._visited(obj, visited, foreign), True))
+        return to_str(parts)
+
+    def svos(self):
+        coref = self.coref
+        svos = []
+        for expanded_verb, subs, verbNegated, _ in self.verbs:
+            visited = {verb.i for verb in expanded_verb}
+            # visited indices of the other sentences that antecedents come from, see _visited
+            foreign = {}
+            # hopefully there are subs, if not, don't examine this verb any longer
+            if len(subs) > 0:
+                isConjVerb, conjV = _right_of_verb_is_conj_verb(expanded_verb)
+                if isConjVerb:
+                    # is_pas = conjV in passive_verbs
+                    v2, objs = _get_all_objs(conjV, visited, False)
+                    for sub in subs:
+                        sub, visited = _process_relative_word_and_pron([sub], visited, coref)
+                        sub = sub[0]
+                        if len(objs) > 0:
+                            # objNegated = _is_negated(obj)
+                            objs, visited = _process_relative_word_and_pron(objs, visited, coref)
+
+                            svos.append((self._subject(sub, visited, foreign),
+                                         "!" + to_str(expanded_verb) if verbNegated else to_str(
+                                             expanded_verb),
+                                         self._objects(objs, visited, foreign)))
+                            svos.append((self._subject(sub, visited, foreign),
+                                         "!" + to_str(v2) if verbNegated else to_str(v2),
+                                         self._objects(objs, visited, foreign)))
+                        else:
+                            svos.append((self._subject(sub, visited, foreign),
+                                         "!" + to_str(expanded_verb) if verbNegated else to_str(expanded_verb),))
+                else:
+                    # is_pas = v in passive_verbs
+                    v, objs = _get_all_objs(expanded_verb, visited, False)
+                    for sub in subs:
+                        sub, visited = _process_relative_word_and_pron([sub], visited, coref)
+                        sub = sub[0]
+                        if len(objs) > 0:
+                            # objNegated = _is_negated(obj)
+                            objs, visited = _process_relative_word_and_pron(objs, visited, coref)
+
+                            svos.append((self._subject(sub, visited, foreign),
+                                         "!" + to_str(v) if verbNegated else to_str(v),
+                                         self._objects(objs, visited, foreign)))
+                        else:
+                            # no obj - just return the SV parts
+                            svos.append((self._subject(sub, visited, foreign),
+                                         "!" + to_str(v) if verbNegated else to_str(v),))
+
+        return svos
+
+    def sms(self):
+        sms = set()
+        for expanded_verb, subs, _, _ in self.verbs:
+            visited = {verb.i for verb in expanded_verb}
+            foreign = {}
+            # hopefully there are subs, if not, don't examine this verb any longer
+            if len(subs) > 0:
+                for sub in subs:
+                    sub, visited = _process_relative_word_and_pron([sub], visited, self.coref)
+                    sub = sub[0]
+                    sms.add((self._subject(sub, visited, foreign), self._modifier(sub, visited, foreign)))
+
+        return list(sms)
+
+    def vms(self):
+        tokens = self.tokens
+        vms = []
+        for expanded_verb, _, _, children in self.verbs:
+            visited = {verb.i for verb in expanded_verb}
+            p_mods = _get_mods_from_prepositions(children, tokens, visited)
+            c_mods = _get_mods_from_clauses(children, tokens, visited)
+            i_mods = _get_mods_from_inf(children, tokens, visited)
+            if len(p_mods) > 0:
+                vms.append((to_str(expanded_verb), [to_str(p_mod) for p_mod in p_mods]))
+            elif len(c_mods) > 0:
+                vms.append((to_str(expanded_verb), [to_str(c_mod) for c_mod in c_mods]))
+            elif len(i_mods) > 0:
+                vms.append((to_str(expanded_verb), [to_str(i_mod) for i_mod in i_mods]))
+            else:
+                vms.append((to_str(expanded_verb), ''))
 
-    return vms
+        return vms
@@ -0,0 +1,141 @@
+import resource
+import threading
+import time
+
+import torch
+
+from metrics import registry
+
+# token lengths the models are warmed up on: a short sentence, a typical one and the tagger limit (MAX_LEN)
+WARMUP_LENGTHS = (8, 32, 80)
+
+# every session created so far, see report
+SESSIONS = []
+
+# held by calls on a GPU from the reset of the CUDA peak memory statistics until the peak is read, the statistics
+# are shared by every thread of the process
+_CUDA_LOCK = threading.Lock()
+
+
+# device of the torch backend, the first GPU when there is one. The quantized and onnx backends always run on
+# the CPU.
+def device_for(backend="torch"):
+    if backend == "torch" and torch.cuda.is_available():
+        return torch.device("cuda:0")
+    return torch.device("cpu")
+
+
+class InferenceSession:
+    """Calls a model without autograd and records the latency and memory of every call.
+
+    ``model`` is called lazily, so it can be a LazyResource that is only loaded
+    by the first call; with ``method`` that method of the model is called
+    instead. Tensor arguments are moved to the device of the model. Calls run
+    under ``torch.inference_mode``, or ``torch.no_grad`` with
+    ``inference_mode=False`` for models whose outputs are modified in place
+    later. The torch threads are those of the process, see ``set_threads``.
+
+    The latency of every call is recorded in the metrics registry with the
+    label ``model=name`` and kept in ``stats()``. On a GPU so is the peak CUDA
+    memory allocated during the call; calls on a GPU are serialized, so that
+    the peaks of calls from other threads do not mix. The CPU has no per-call
+    peak, ``process_peak_rss_bytes`` records the peak resident set size of
+    the process since it started instead.
+    """
+
+    def __init__(self, name, model, method=None, inference_mode=True):
+        self.name = name
+        self.model = model
+        self.method = method
+        self.inference_mode = inference_mode
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        # None until a call on a GPU
+        self.peak_bytes = None
+        self._lock = threading.Lock()
+        SESSIONS.append(self)
+
+    @property
+    def device(self):
+        return getattr(self.model, "device", None) or torch.device("cpu")
+
+    def __call__(self, *args, **kwargs):
+        device = self.device
+        if device.type == "cuda":
+            with _CUDA_LOCK:
+                torch.cuda.reset_peak_memory_stats(device)
+                start = time.perf_counter()
+                output = self._run(device, args, kwargs)
+                torch.cuda.synchronize(device)
+                seconds = time.perf_counter() - start
+                peak = torch.cuda.max_memory_allocated(device)
+        else:
+            start = time.perf_counter()
+            output = self._run(device, args, kwargs)
+            seconds = time.perf_counter() - start
+            peak = None
+
+        with self._lock:
+            self.calls += 1
+            self.seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            if peak is not None:
+                self.peak_bytes = max(self.peak_bytes or 0, peak)
+        registry.info("device", device, model=self.name)
+        registry.observe("inference_seconds", seconds, model=self.name)
+        if peak is not None:
+            registry.observe("inference_peak_bytes", peak, model=self.name)
+        elif registry.enabled:
+            registry.observe("process_peak_rss_bytes", process_peak_rss())
+        return output
+
+    # run the model once per argument tuple in `inputs`, the calls are not recorded
+    def warmup(self, inputs):
+        device = self.device
+        for args in inputs:
+            self._run(device, args, {})
+
+    def stats(self):
+        return {
+            "model": self.name,
+            "device": str(self.device) if self.calls else None,
+            "calls": self.calls,
+            "mean_ms": self.seconds / self.calls * 1000 if self.calls else 0.0,
+            "max_ms": self.max_seconds * 1000,
+            "peak_bytes": self.peak_bytes,
+        }
+
+    def _run(self, device, args, kwargs):
+        args = [arg.to(device) if isinstance(arg, torch.Tensor) else arg for arg in args]
+        call = self.model if self.method is None else getattr(self.model, self.method)
+        with torch.inference_mode() if self.inference_mode else torch.no_grad():
+            return call(*args, **kwargs)
+
+
+# (input_ids, attention_mask) batches of every length in `lengths`, for warming up a model that takes token ids.
+# The ids are all `token_id`, only the shapes matter.
+def token_inputs(lengths=WARMUP_LENGTHS, batch_size=1, token_id=0):
+    for length in lengths:
+        yield (torch.full((batch_size, length), token_id, dtype=torch.long),
+               torch.ones((batch_size, length), dtype=torch.long))
+
+
+# the stats of every session that has been called
+def report():
+    return [session.stats() for session in SESSIONS if session.calls]
+
+
+# set the torch intra-op threads of the process, used by every session, and return the previous count. None leaves
+# them alone.
+def set_threads(threads):
+    previous = torch.get_num_threads()
+    if threads is not None and threads != previous:
+        torch.set_num_threads(threads)
+    return previous
+
+
+# the peak resident set size of the process since it started, not of a single call
+def process_peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,182 @@
+import json
+import threading
+import time
+
+# prefix of every metric name in the Prometheus export
+PREFIX = "extraction_"
+
+
+class MetricsRegistry:
+    """Counters, summaries and info values recorded by the pipeline stages.
+
+    Nothing is recorded until ``enable`` is called, every recording method
+    returns right away while the registry is disabled. Metrics are identified by
+    a name and keyword labels, e.g. ``count("ce_gate", outcome="classifier")``.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._summaries = {}
+        self._info = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+            self._info.clear()
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    # add a value to the count / sum / min / max summary of a metric
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                self._summaries[key] = [1, value, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = min(summary[2], value)
+                summary[3] = max(summary[3], value)
+
+    # a value that is described rather than counted, such as the device of a model
+    def info(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._info[(name, tuple(sorted(labels.items())))] = str(value)
+
+    # time the block as one call of `stage` that processed `items` items
+    def stage(self, stage, items=1):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, stage, items)
+
+    # the value of a counter, the summary dict of a summary or the value of an info, None if never recorded
+    def get(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            if key in self._summaries:
+                return _summary_dict(self._summaries[key])
+            return self._info.get(key)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self._counters.items())],
+                "summaries": [{"name": name, "labels": dict(labels), **_summary_dict(summary)}
+                              for (name, labels), summary in sorted(self._summaries.items())],
+                "info": [{"name": name, "labels": dict(labels), "value": value}
+                         for (name, labels), value in sorted(self._info.items())],
+            }
+
+    # add a snapshot taken in another process, e.g. a worker of runner.py
+    def merge(self, snapshot):
+        with self._lock:
+            for counter in snapshot["counters"]:
+                key = (counter["name"], tuple(sorted(counter["labels"].items())))
+                self._counters[key] = self._counters.get(key, 0) + counter["value"]
+            for other in snapshot["summaries"]:
+                key = (other["name"], tuple(sorted(other["labels"].items())))
+                summary = self._summaries.get(key)
+                if summary is None:
+                    self._summaries[key] = [other["count"], other["sum"], other["min"], other["max"]]
+                else:
+                    summary[0] += other["count"]
+                    summary[1] += other["sum"]
+                    summary[2] = min(summary[2], other["min"])
+                    summary[3] = max(summary[3], other["max"])
+            for info in snapshot["info"]:
+                self._info[(info["name"], tuple(sorted(info["labels"].items())))] = info["value"]
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    # Prometheus text exposition format
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        # the samples of a metric have to follow its TYPE line
+        families = {}
+
+        def add(name, kind, labels, value):
+            families.setdefault(name, [f"# TYPE {name} {kind}"]).append(f"{name}{_labels(labels)} {value}")
+
+        for counter in snapshot["counters"]:
+            add(PREFIX + counter["name"] + "_total", "counter", counter["labels"], counter["value"])
+        for summary in snapshot["summaries"]:
+            name = PREFIX + summary["name"]
+            add(name + "_count", "counter", summary["labels"], summary["count"])
+            add(name + "_sum", "counter", summary["labels"], summary["sum"])
+            add(name + "_max", "gauge", summary["labels"], summary["max"])
+        for info in snapshot["info"]:
+            add(PREFIX + info["name"] + "_info", "gauge", {**info["labels"], "value": info["value"]}, 1)
+        return "".join(line + "\n" for lines in families.values() for line in lines)
+
+
+class _StageTimer:
+    def __init__(self, registry, stage, items):
+        self.registry = registry
+        self.stage = stage
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe("stage_seconds", time.perf_counter() - self.start, stage=self.stage)
+        self.registry.count("stage_items", self.items, stage=self.stage)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+# nearest-rank percentile of a sorted list
+def percentile(values, q):
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+def _summary_dict(summary):
+    count, total, minimum, maximum = summary
+    return {"count": count, "sum": total, "min": minimum, "max": maximum, "mean": total / count}
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+# the registry the pipeline records into
+registry = MetricsRegistry()
@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+from collections import deque
+from itertools import islice
+
+import spacy
+from spacy.tokens import Doc, DocBin
+
+import pipeline
+from component import ENGINES
+from coref import window_chains
+from extract import nlp
+
+# parsed sentences per DocBin file
+SHARD_SIZE = 10000
+MANIFEST = "manifest.json"
+
+# coreference of a saved sentence as [token index, sentence offset, antecedent index] triples, the antecedent is
+# a token of the sentence `offset` sentences after this one (0: the sentence itself). None if coref did not run.
+if not Doc.has_extension("coref_links"):
+    Doc.set_extension("coref_links", default=None)
+
+
+# parse texts and resolve their coreference like extract_stream does and save the parses to sharded DocBin files
+# in directory, so that the rules can be run again without the parser and the coreference model
+def save_parses(texts, directory, shard_size=SHARD_SIZE, batch_size=32, use_coref=True, coref_window=None):
+    os.makedirs(directory, exist_ok=True)
+    batches = pipeline._read_stage(texts, batch_size)
+    batches = pipeline._parse_stage(batches, batch_size)
+    batches = pipeline._coref_stage(batches, use_coref, coref_window)
+
+    shards = []
+    shard = DocBin(store_user_data=True)
+    # (doc, position in the corpus) of the recent docs, antecedents are looked up here. The docs are kept rather
+    # than their ids, which are reused once a doc is freed.
+    recent = deque()
+    count = 0
+    for stage_batch in batches:
+        recent.extend(zip(stage_batch.tokens, range(count, count + len(stage_batch.tokens))))
+        while len(recent) > len(stage_batch.tokens) + (coref_window or 0):
+            recent.popleft()
+        for doc, chains in zip(stage_batch.tokens, stage_batch.corefs):
+            doc._.coref_links = None if chains is None else _links(chains, count, recent)
+            shard.add(doc)
+            count += 1
+            if len(shard) == shard_size:
+                shards.append(_write_shard(shard, directory, len(shards)))
+                shard = DocBin(store_user_data=True)
+    if len(shard) > 0:
+        shards.append(_write_shard(shard, directory, len(shards)))
+
+    manifest = {"sentences": count, "shards": shards, "lang": nlp.lang,
+                "model": f"{nlp.meta['name']}-{nlp.meta['version']}", "use_coref": use_coref,
+                "coref_window": coref_window}
+    with open(os.path.join(directory, MANIFEST), "w", encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _links(chains, position, recent):
+    if isinstance(chains, window_chains):
+        return [[index, next(at for doc, at in recent if doc is token.doc) - position, token.i]
+                for index, token in sorted(chains.representatives.items())]
+    return [[index, 0, representative] for index, representative in sorted(chains.representatives.items())]
+
+
+def _write_shard(shard, directory, number):
+    name = f"shard-{number:05d}.spacy"
+    shard.to_disk(os.path.join(directory, name))
+    return name
+
+
+# yield (doc, coreference resolver or None) for every saved sentence in corpus order. A blank vocab of the same
+# language is used by default, so the parser is not loaded.
+def read_parses(directory, vocab=None):
+    with open(os.path.join(directory, MANIFEST), "r", encoding='utf-8') as f:
+        manifest = json.load(f)
+    if vocab is None:
+        vocab = spacy.blank(manifest["lang"]).vocab
+    # antecedents can only be in the same coreference window
+    reach = max(1, manifest["coref_window"] or 0)
+
+    docs = (doc for name in manifest["shards"]
+            for doc in DocBin().from_disk(os.path.join(directory, name)).get_docs(vocab))
+    history = deque(maxlen=reach)
+    ahead = deque(islice(docs, reach + 1))
+    while ahead:
+        doc = ahead.popleft()
+        yield doc, _resolver(doc, history, ahead)
+        history.append(doc)
+        ahead.extend(islice(docs, 1))
+
+
+def _resolver(doc, history, ahead):
+    links = doc._.coref_links
+    if links is None:
+        return None
+    representatives = {}
+    for index, offset, antecedent in links:
+        if offset == 0:
+            representatives[index] = doc[antecedent]
+        elif offset < 0 and -offset <= len(history):
+            representatives[index] = history[offset][antecedent]
+        elif 0 < offset <= len(ahead):
+            representatives[index] = ahead[offset - 1][antecedent]
+    return window_chains(representatives)
+
+
+# run the SVO / SM / VM rules (pipeline.ANALYSIS) again over saved parses, CE is None
+def reextract(directory):
+    for doc, chains in read_parses(directory):
+        yield pipeline.ExtractionResult(doc.text, *pipeline.ANALYSIS(doc, chains).relations(), None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Save parsed sentences to DocBin files and run the relation rules "
+                                                 "over them again without re-parsing.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parse_parser = subparsers.add_parser("parse", help="parse a corpus with one sentence per line and save it")
+    parse_parser.add_argument("input", help="input file, one sentence per line")
+    parse_parser.add_argument("directory", help="directory for the DocBin shards")
+    parse_parser.add_argument("--shard-size", type=int, default=SHARD_SIZE, help="sentences per shard")
+    parse_parser.add_argument("--batch-size", type=int, default=32)
+    parse_parser.add_argument("--coref-window", type=int, default=None,
+                              help="resolve coreference over windows of this many consecutive lines")
+    parse_parser.add_argument("--no-coref", dest="use_coref", action="store_false", help="skip coreference resolution")
+
+    extract_parser = subparsers.add_parser("extract", help="extract relations from saved parses")
+    extract_parser.add_argument("directory", help="directory written by the parse command")
+    extract_parser.add_argument("output", help="output JSONL file, one result per sentence")
+    extract_parser.add_argument("--engine", default="token", choices=sorted(ENGINES),
+                                help="rule engine, see pipeline.ANALYSIS")
+
+    args = parser.parse_args()
+    if args.command == "parse":
+        with open(args.input, "r", encoding='utf-8') as f:
+            texts = (line.rstrip('\n') for line in f)
+            manifest = save_parses(texts, args.directory, args.shard_size, args.batch_size, args.use_coref,
+                                   args.coref_window)
+        print(f"saved {manifest['sentences']} parses in {len(manifest['shards'])} shards to {args.directory}")
+    elif args.command == "extract":
+        pipeline.ANALYSIS = ENGINES[args.engine]
+        with open(args.output, "w", encoding='utf-8') as out:
+            for result in reextract(args.directory):
+                out.write(json.dumps(result.to_dict(), ensure_ascii=False) + '\n')
+
+
+if __name__ == "__main__":
+    main()
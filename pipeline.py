@@ -1,17 +1,377 @@
-from extract import findSVOs, findSMs, findVMs, nlp
-from coref import coref_chains
-from causal_extractor import cause_effect_extraction
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+from itertools import islice
+
+import spacy
+
+import extract
+import coref
+import causal_extractor
+import inference
+from cache import fingerprint
+from component import ENGINES, relation_nlp, relations
+from metrics import registry
+from extract import DocumentAnalysis, nlp
+from coref import coref_chains, windowed_coref
+from causal_extractor import cause_effect_extraction, batch_cause_effect_extraction
+
+
+# class that runs the SVO / SM / VM rules on a parsed sentence, set it to array_engine.ArrayAnalysis to run the
+# rules on arrays exported from the Doc instead of spaCy Token objects
+ANALYSIS = DocumentAnalysis
+
+# bump when a change to the rules changes the results, so that results cached by an older version are not reused
+CACHE_VERSION = 1
+
+# batches the parse / coref / rules thread may work ahead of the CE models with overlap=True
+OVERLAP_DEPTH = 2
+
+
+class ExtractionResult(namedtuple("ExtractionResult", ["text", "svos", "sms", "vms", "ce"])):
+    __slots__ = ()
+
+    def to_dict(self):
+        return {"text": self.text, "svo": self.svos, "sm": self.sms, "vm": self.vms, "ce": self.ce}
 
 
 class pipeline:
-    def __init__(self, text):
+    # use_coref / use_ce switch the coreference and cause-and-effect stages off, their results are then None
+    def __init__(self, text, use_coref=True, use_ce=True):
         self.text = text
-        tokens = nlp(text)
-        self.doc = coref_chains(text)
-        self.svos = findSVOs(tokens, self.doc)
-        self.sms = findSMs(tokens, self.doc)
-        self.vms = findVMs(tokens)
-        self.ce = cause_effect_extraction(text)
+        with registry.stage("parse"):
+            tokens = nlp(text)
+        self.doc = None
+        if use_coref:
+            with registry.stage("coref"):
+                self.doc = coref_chains(text)
+        self._extract(tokens)
+        self.ce = None
+        if use_ce:
+            with registry.stage("ce"):
+                self.ce = cause_effect_extraction(text, tokens)
+
+    def _extract(self, tokens):
+        with registry.stage("rules"):
+            self.svos, self.sms, self.vms = ANALYSIS(tokens, self.doc).relations()
+
+    # load every model needed by the enabled stages instead of waiting for the first sentence
+    @staticmethod
+    def load(use_coref=True, use_ce=True):
+        extract.nlp.load()
+        extract.collocation.load()
+        if use_coref:
+            coref.load()
+        if use_ce:
+            causal_extractor.load()
+
+    # process many sentences at once, results are identical to pipeline(text) for each text unless coref_window
+    # is set, see extract_stream. Sentences found in `cache` get doc None.
+    @classmethod
+    def batch(cls, texts, batch_size=32, use_coref=True, use_ce=True, coref_window=None, cache=None, n_process=1,
+              overlap=False, torch_threads=None):
+        results = []
+        for stage_batch in _run_stages(texts, batch_size, use_coref, use_ce, coref_window, cache, n_process, overlap,
+                                       torch_threads):
+            for text, doc, rels, ce in zip(stage_batch.texts, stage_batch.corefs, stage_batch.relations,
+                                           stage_batch.ces):
+                item = cls.__new__(cls)
+                item.text = text
+                item.doc = doc
+                item.svos, item.sms, item.vms = rels
+                item.ce = ce
+                results.append(item)
+        return results
+
+    # the same JSON shape as the results of extract_stream
+    def to_dict(self):
+        return ExtractionResult(self.text, self.svos, self.sms, self.vms, self.ce).to_dict()
 
     def __str__(self):
         return f"text: {self.text}\n" + f"SVO:  {self.svos}\n" + f"SM:   {self.sms}\n" + f"VM:   {self.vms}\n" + f"CE:   {self.ce}"
+
+
+# extract relations from an iterable of sentences and yield an ExtractionResult per sentence, in input order.
+# Every stage pulls one batch at a time from the stage before it, so at most a few batches are held in memory
+# and a slow consumer holds back the parser and the models.
+# By default every sentence is resolved on its own. When the texts are consecutive sentences of a document,
+# coref_window=n resolves them together over windows of n sentences (see coref.windowed_coref), which shares one
+# longformer pass between n // 2 sentences and finds antecedents in the previous sentences.
+# With a cache.ResultCache as `cache`, only sentences that are not in the cache go through the stages. The cache
+# fingerprint should come from cache_fingerprint with the same stage flags. A sentence resolved within a window
+# depends on its neighbours, so coref_window can not be combined with a cache.
+# n_process > 1 parses in that many processes with nlp.pipe(n_process=...). Without coref the rules run in those
+# processes too, as the relation_extractor component (see component.py). The processes read ahead, so n_process > 1
+# can not be combined with a cache.
+# overlap=True runs the parser in a background thread that works up to OVERLAP_DEPTH batches ahead while the models
+# process the current batch, and the rules too when coref is off. The coreference and the CE models stay in the
+# calling thread, the background thread runs no torch code.
+# torch_threads sets the torch intra-op threads for the duration of the stream, with or without overlap. With
+# overlap leave a core to the background thread, e.g. cores - 1, so that the two do not oversubscribe the CPU.
+def extract_stream(texts, batch_size=32, use_coref=True, use_ce=True, coref_window=None, cache=None, n_process=1,
+                   overlap=False, torch_threads=None):
+    for stage_batch in _run_stages(texts, batch_size, use_coref, use_ce, coref_window, cache, n_process, overlap,
+                                   torch_threads):
+        for text, rels, ce in zip(stage_batch.texts, stage_batch.relations, stage_batch.ces):
+            yield ExtractionResult(text, *rels, ce)
+
+
+# fingerprint of the models, data files and settings the results of the enabled stages depend on, for a
+# cache.ResultCache shared by processes that run with the same configuration. The spaCy pipeline is loaded to
+# read its name and version.
+def cache_fingerprint(use_coref=True, use_ce=True):
+    resources = [extract.nlp, extract.collocation]
+    if use_coref:
+        resources.append(coref.inference_model)
+    if use_ce:
+        resources += [causal_extractor.causal_classifier.model, causal_extractor.model]
+    parts = [CACHE_VERSION, use_coref, use_ce, spacy.__version__, extract.nlp.meta["lang"], extract.nlp.meta["name"],
+             extract.nlp.meta["version"]]
+    for resource in resources:
+        for key, value in sorted(resource.options.items()):
+            parts += [key, value]
+    if use_ce:
+        parts += [causal_extractor.GATE, causal_extractor.NOT_RELEVANT_THRESHOLD, causal_extractor.OVERFLOW,
+                  causal_extractor.MAX_LEN, causal_extractor.WINDOW_STRIDE]
+    if use_ce and causal_extractor.PREFILTER is not None:
+        prefilter = causal_extractor.PREFILTER
+        parts.append(type(prefilter).__name__)
+        for key, value in sorted(vars(prefilter).items()):
+            parts += [key, sorted(value) if isinstance(value, (set, frozenset)) else value]
+    return fingerprint(*parts)
+
+
+# the sentences of one batch and what the stages have produced for them so far
+class _StageBatch:
+    def __init__(self, texts):
+        self.texts = texts
+        self.tokens = None
+        self.corefs = None
+        self.relations = None
+        self.ces = None
+        # with a cache: every sentence of the batch and either its cached (relations, ce) or the index of the
+        # sentence in `texts`, which then only holds the sentences that were not found
+        self.all_texts = None
+        self.cached = None
+
+
+def _run_stages(texts, batch_size, use_coref, use_ce, coref_window=None, cache=None, n_process=1, overlap=False,
+                torch_threads=None):
+    if cache is not None and coref_window is not None:
+        raise ValueError("results resolved over a coreference window can not be cached")
+    # the parser processes read batches ahead, the lookups of later batches would run before the results of
+    # earlier ones are stored and a warm cache would be read to the end before the first result
+    if cache is not None and n_process > 1:
+        raise ValueError("a result cache can not be combined with n_process > 1")
+    batches = _read_stage(texts, batch_size)
+    if cache is not None:
+        batches = _cache_lookup_stage(batches, cache)
+    # the rules can only run next to the parser when they do not need the coreference of the sentence
+    engine = None
+    if n_process > 1 and not use_coref:
+        engine = next((name for name, analysis in ENGINES.items() if analysis is ANALYSIS), None)
+    batches = _parse_stage(batches, batch_size, n_process, engine)
+    # with overlap the stages up to here run in a background thread. The coreference model stays with the CE models
+    # in the calling thread, so that only one thread runs torch; the rules then follow the coreference.
+    if not use_coref:
+        batches = _rule_stage(_coref_stage(batches, use_coref, coref_window))
+    if overlap:
+        batches = _overlap_stage(batches, OVERLAP_DEPTH)
+    if use_coref:
+        batches = _rule_stage(_coref_stage(batches, use_coref, coref_window))
+    batches = _ce_stage(batches, batch_size, use_ce)
+    if cache is not None:
+        batches = _cache_store_stage(batches, cache)
+    if torch_threads is not None:
+        batches = _thread_stage(batches, torch_threads)
+    return batches
+
+
+def _read_stage(texts, batch_size):
+    texts = iter(texts)
+    while True:
+        chunk = list(islice(texts, batch_size))
+        if len(chunk) == 0:
+            return
+        registry.observe("batch_size", len(chunk))
+        yield _StageBatch(chunk)
+
+
+# parse the sentences of every batch. With n_process > 1 the sentences of all batches go through one nlp.pipe call,
+# so that its processes are started once; the parser then reads batches ahead of the one it yields. With an engine
+# the relation_extractor component also runs the rules.
+def _parse_stage(batches, batch_size, n_process=1, engine=None):
+    parser = nlp
+    if engine is not None:
+        if relation_nlp.options.get("engine") != engine:
+            relation_nlp.configure(engine=engine)
+        parser = relation_nlp
+    if n_process == 1:
+        for stage_batch in batches:
+            with registry.stage("parse", len(stage_batch.texts)):
+                stage_batch.tokens = list(parser.pipe(stage_batch.texts, batch_size=batch_size))
+            yield stage_batch
+        return
+
+    # batches whose sentences have been handed to the parser, in order. Every batch has sentences, there is no
+    # cache in front of this stage.
+    pending = deque()
+
+    def texts():
+        for stage_batch in batches:
+            pending.append(stage_batch)
+            yield from stage_batch.texts
+
+    parsed = iter(parser.pipe(texts(), batch_size=batch_size, n_process=n_process))
+    while True:
+        # the first parse of a batch reads it, and maybe the batches after it, and waits for the processes
+        start = time.perf_counter()
+        doc = next(parsed, None)
+        if doc is None:
+            return
+        stage_batch = pending.popleft()
+        stage_batch.tokens = [doc] + [next(parsed) for _ in stage_batch.texts[1:]]
+        registry.observe("stage_seconds", time.perf_counter() - start, stage="parse")
+        registry.count("stage_items", len(stage_batch.texts), stage="parse")
+        yield stage_batch
+
+
+def _coref_stage(batches, use_coref, coref_window):
+    # the sentences before the current batch, used as antecedents by the coreference windows
+    context = []
+    for stage_batch in batches:
+        if not use_coref:
+            stage_batch.corefs = [None] * len(stage_batch.texts)
+            yield stage_batch
+            continue
+        with registry.stage("coref", len(stage_batch.texts)):
+            if coref_window is None:
+                stage_batch.corefs = [coref_chains(text) for text in stage_batch.texts]
+            else:
+                stage_batch.corefs = windowed_coref(stage_batch.tokens, coref_window, max(1, coref_window // 2),
+                                                    context)
+                context = (context + stage_batch.tokens)[-(coref_window - 1):] if coref_window > 1 else []
+        yield stage_batch
+
+
+def _rule_stage(batches):
+    for stage_batch in batches:
+        with registry.stage("rules", len(stage_batch.texts)):
+            stage_batch.relations = [relations(tokens) if tokens._.svos is not None else
+                                     ANALYSIS(tokens, doc).relations()
+                                     for tokens, doc in zip(stage_batch.tokens, stage_batch.corefs)]
+        yield stage_batch
+
+
+# marks the end of the batches handed over by _overlap_stage
+_DONE = object()
+
+
+# Run the stages before this one in a background thread and hand their batches over through a queue of `depth`
+# batches. The parser and the rules hold the GIL, the torch models release it while they compute, so the next
+# batches are parsed while the models work on the current one.
+def _overlap_stage(batches, depth=OVERLAP_DEPTH):
+    handoff = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    # False once the consumer has stopped reading
+    def put(item):
+        while not stop.is_set():
+            try:
+                handoff.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for stage_batch in batches:
+                if not put(stage_batch):
+                    return
+            put(_DONE)
+        except BaseException as error:
+            put(error)
+        finally:
+            # closes nlp.pipe and its processes in the thread that runs them
+            batches.close()
+
+    producer = threading.Thread(target=produce, name="extraction-stages", daemon=True)
+    producer.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            item = handoff.get()
+            # time the models waited for the parser, near 0 when the parser keeps up
+            registry.observe("overlap_wait_seconds", time.perf_counter() - start)
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+# set the torch intra-op threads while the batches are read and restore the previous count afterwards
+def _thread_stage(batches, torch_threads):
+    previous = inference.set_threads(torch_threads)
+    try:
+        yield from batches
+    finally:
+        inference.set_threads(previous)
+
+
+def _ce_stage(batches, batch_size, use_ce):
+    for stage_batch in batches:
+        if use_ce:
+            with registry.stage("ce", len(stage_batch.texts)):
+                stage_batch.ces = batch_cause_effect_extraction(stage_batch.texts, batch_size, stage_batch.tokens)
+        else:
+            stage_batch.ces = [None] * len(stage_batch.texts)
+        # the parses are not needed after the last stage
+        stage_batch.tokens = None
+        yield stage_batch
+
+
+def _cache_lookup_stage(batches, cache):
+    for stage_batch in batches:
+        stage_batch.all_texts = stage_batch.texts
+        stage_batch.cached = []
+        stage_batch.texts = []
+        # repeated sentences within the batch are only looked up and extracted once
+        found = {}
+        for text in stage_batch.all_texts:
+            key = cache.key(text)
+            if key not in found:
+                hit = cache.get(text)
+                if hit is None:
+                    hit = len(stage_batch.texts)
+                    stage_batch.texts.append(text)
+                found[key] = hit
+            stage_batch.cached.append(found[key])
+        yield stage_batch
+
+
+# store the new results and put the cached ones back in input order
+def _cache_store_stage(batches, cache):
+    for stage_batch in batches:
+        computed = list(zip(stage_batch.corefs, stage_batch.relations, stage_batch.ces))
+        for text, (doc, relation, ce) in zip(stage_batch.texts, computed):
+            cache.put(text, (relation, ce))
+        corefs, rels, ces = [], [], []
+        for hit in stage_batch.cached:
+            if isinstance(hit, int):
+                doc, relation, ce = computed[hit]
+            else:
+                doc = None
+                relation, ce = hit
+            corefs.append(doc)
+            rels.append(relation)
+            ces.append(ce)
+        stage_batch.texts = stage_batch.all_texts
+        stage_batch.corefs, stage_batch.relations, stage_batch.ces = corefs, rels, ces
+        stage_batch.all_texts = stage_batch.cached = None
+        yield stage_batch
@@ -0,0 +1,71 @@
+import threading
+
+
+class LazyResource:
+    """A model or data file that is only created when it is first used.
+
+    The resource proxies attribute access, calls and membership tests to the
+    underlying object, so module level names such as ``extract.nlp`` keep
+    working while nothing is loaded at import time. Call ``configure`` to change
+    how it will be created and ``load`` to create it eagerly.
+    """
+
+    def __init__(self, factory, **options):
+        self._factory = factory
+        self._options = options
+        self._value = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._value is not None
+
+    @property
+    def options(self):
+        return dict(self._options)
+
+    # change the factory options, an already created resource is dropped and rebuilt on next use
+    def configure(self, **options):
+        with self._lock:
+            self._options.update(options)
+            self._value = None
+        return self
+
+    def load(self, **options):
+        if options:
+            self.configure(**options)
+        return self.get()
+
+    def get(self):
+        value = self._value
+        if value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory(**self._options)
+                value = self._value
+        return value
+
+    def unload(self):
+        with self._lock:
+            self._value = None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.get()(*args, **kwargs)
+
+    def __contains__(self, item):
+        return item in self.get()
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __len__(self):
+        return len(self.get())
+
+    def __repr__(self):
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<LazyResource {getattr(self._factory, '__name__', self._factory)} ({state})>"
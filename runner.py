@@ -0,0 +1,177 @@
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+from collections import deque
+from itertools import islice
+
+import causal_extractor
+import inference
+from backends import BACKENDS
+from cache import ResultCache
+from metrics import registry
+from pipeline import pipeline, extract_stream, cache_fingerprint
+
+_options = {}
+# whether _process hands the metrics it recorded back to the parent, only in worker processes started with metrics
+_report_metrics = False
+
+
+def _init_worker(options, torch_threads, backend, cache_options=None, metrics=False):
+    global _report_metrics
+    _options.update(options)
+    if metrics:
+        registry.enable()
+        _report_metrics = True
+    if torch_threads:
+        inference.set_threads(torch_threads)
+    causal_extractor.set_backend(backend)
+    if cache_options is not None:
+        # every worker has its own memory tier, the disk tier is shared
+        _options["cache"] = ResultCache(fingerprint=cache_fingerprint(options["use_coref"], options["use_ce"]),
+                                        **cache_options)
+    # every worker loads its models once and keeps them for all of its batches, preloaded models are already there
+    pipeline.load(use_coref=options["use_coref"], use_ce=options["use_ce"])
+
+
+# Load every model in this process, before the workers are forked. The workers then share the memory pages of the
+# weights with this process instead of loading their own copies, pages are only copied when they are written to.
+def preload(options, backend):
+    # an OpenMP thread pool started here would not work in the forked workers, they set their own thread count
+    inference.set_threads(1)
+    causal_extractor.set_backend(backend)
+    pipeline.load(use_coref=options["use_coref"], use_ce=options["use_ce"])
+    # the garbage collector writes to every object it tracks, frozen objects are left alone so that their pages
+    # stay shared
+    gc.collect()
+    gc.freeze()
+
+
+# worker pool for _process, with preload_models the models are loaded once and shared by forked workers
+def _pool(workers, options, torch_threads, backend, cache_options=None, metrics=False, preload_models=False):
+    context = multiprocessing.get_context()
+    if preload_models:
+        preload(options, backend)
+        context = multiprocessing.get_context("fork")
+    return context.Pool(workers, initializer=_init_worker,
+                        initargs=(options, torch_threads, backend, cache_options, metrics))
+
+
+# The JSON lines of the texts and the metrics recorded while they were processed, if this is a worker that reports
+# them. Called in the process that owns the registry, e.g. by service.py without workers, the metrics stay where they
+# were recorded and None is returned.
+def _process(texts):
+    records = [json.dumps(result.to_dict(), ensure_ascii=False)
+               for result in extract_stream(texts, len(texts), **_options)]
+    if not _report_metrics:
+        return records, None
+    snapshot = registry.snapshot()
+    registry.reset()
+    return records, snapshot
+
+
+# read batches of lines from the input, starting after the first `offset` lines
+def _read_batches(path, batch_size, offset):
+    with open(path, "r", encoding='utf-8') as f:
+        lines = (line.rstrip('\n') for line in islice(f, offset, None))
+        while True:
+            batch = list(islice(lines, batch_size))
+            if len(batch) == 0:
+                return
+            yield batch
+
+
+def _count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r", encoding='utf-8') as f:
+        return sum(1 for _ in f)
+
+
+# extract every line of input_path into output_path as JSONL, results are written in input order
+def run(input_path, output_path, workers=None, batch_size=16, offset=None, use_coref=True, use_ce=True,
+        torch_threads=1, backend="torch", coref_window=None, cache_path=None, cache_memory=None, metrics=False,
+        preload_models=False, overlap=False):
+    workers = workers or os.cpu_count()
+    if offset is None:
+        # resume after the results that are already in the output file
+        offset = _count_lines(output_path)
+    options = {"use_coref": use_coref, "use_ce": use_ce, "coref_window": coref_window, "overlap": overlap}
+    cache_options = None
+    if cache_path is not None or cache_memory is not None:
+        cache_options = {"path": cache_path, "max_bytes": (64 if cache_memory is None else cache_memory) * 1024 * 1024}
+
+    with _pool(workers, options, torch_threads, backend, cache_options, metrics, preload_models) as pool, \
+            open(output_path, "a" if offset > 0 else "w", encoding='utf-8') as out:
+        pending = deque()
+        done = offset
+        for batch in _read_batches(input_path, batch_size, offset):
+            pending.append(pool.apply_async(_process, (batch,)))
+            # keep a bounded number of batches in flight so the input is streamed
+            while len(pending) >= workers * 2:
+                done += _write(pending.popleft().get(), out)
+        while pending:
+            done += _write(pending.popleft().get(), out)
+    return done
+
+
+def _write(result, out):
+    records, snapshot = result
+    if snapshot is not None:
+        registry.merge(snapshot)
+    for record in records:
+        out.write(record + '\n')
+    out.flush()
+    return len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract relations from a corpus with one sentence per line.")
+    parser.add_argument("input", help="input file, one sentence per line")
+    parser.add_argument("output", help="output JSONL file, one result per input line")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--batch-size", type=int, default=16, help="sentences sent to a worker at once")
+    parser.add_argument("--offset", type=int, default=None,
+                        help="number of input lines to skip (default: resume after the lines already in output)")
+    parser.add_argument("--torch-threads", type=int, default=1, help="torch intra-op threads per worker")
+    parser.add_argument("--backend", default="torch", choices=BACKENDS, help="inference backend of the CE models")
+    parser.add_argument("--coref-window", type=int, default=None,
+                        help="resolve coreference over windows of this many consecutive lines, "
+                             "windows do not cross batches")
+    parser.add_argument("--cache", dest="cache_path", default=None,
+                        help="SQLite file that caches results across workers and runs")
+    parser.add_argument("--cache-memory", type=int, default=None,
+                        help="size of the in-memory result cache of every worker in MB (default: 64 with --cache, "
+                             "no cache without it)")
+    parser.add_argument("--metrics", default=None,
+                        help="write stage timings and counters of all workers to this file, in the Prometheus text "
+                             "format if it ends with .prom and as JSON otherwise")
+    parser.add_argument("--preload", dest="preload_models", action="store_true",
+                        help="load the models once before forking the workers, which share them (CPU backends "
+                             "torch and quantized)")
+    parser.add_argument("--overlap", action="store_true",
+                        help="parse the next batch in a thread while the CE models run, every worker then uses one "
+                             "core besides its --torch-threads")
+    parser.add_argument("--no-coref", dest="use_coref", action="store_false", help="skip coreference resolution")
+    parser.add_argument("--no-ce", dest="use_ce", action="store_false", help="skip cause-and-effect extraction")
+    args = parser.parse_args()
+    if args.coref_window is not None and (args.cache_path is not None or args.cache_memory is not None):
+        parser.error("--coref-window can not be combined with a result cache")
+    if args.preload_models and (args.backend == "onnx" or causal_extractor.USE_GPU):
+        parser.error("--preload needs the torch or quantized backend on the CPU, ONNX Runtime sessions and CUDA "
+                     "do not survive a fork")
+
+    done = run(args.input, args.output, workers=args.workers, batch_size=args.batch_size, offset=args.offset,
+               use_coref=args.use_coref, use_ce=args.use_ce, torch_threads=args.torch_threads,
+               backend=args.backend, coref_window=args.coref_window, cache_path=args.cache_path,
+               cache_memory=args.cache_memory, metrics=args.metrics is not None, preload_models=args.preload_models,
+               overlap=args.overlap)
+    print(f"{args.output} holds results for {done} input lines")
+    if args.metrics is not None:
+        with open(args.metrics, "w", encoding='utf-8') as f:
+            f.write(registry.to_prometheus() if args.metrics.endswith(".prom") else registry.to_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import cycle, islice
+from urllib.parse import urlsplit
+
+import causal_extractor
+import runner
+from backends import BACKENDS
+from metrics import percentile, registry
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+class MicroBatcher:
+    """Groups items submitted by concurrent requests into batches.
+
+    A batch is dispatched once it holds ``max_batch_size`` items or ``max_wait``
+    seconds after its first item arrived. ``process`` runs in ``executor``, takes
+    a list of items and returns their results with a metrics snapshot or None,
+    like ``runner._process``. At most ``concurrency`` batches run at once, items
+    that arrive meanwhile wait and form the next, larger batches.
+    """
+
+    def __init__(self, process, max_batch_size=32, max_wait=0.01, executor=None, concurrency=1):
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.executor = executor
+        self.concurrency = concurrency
+        self._queue = None
+        self._slots = None
+        self._dispatcher = None
+        self._running = set()
+
+    @property
+    def pending(self):
+        return 0 if self._queue is None else self._queue.qsize()
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def stop(self):
+        self._dispatcher.cancel()
+        for task in list(self._running):
+            await task
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.ensure_future(self._execute(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, batch):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        registry.observe("service_batch_size", len(batch))
+        for _, _, queued in batch:
+            registry.observe("service_queue_seconds", start - queued)
+        try:
+            results, snapshot = await loop.run_in_executor(self.executor, self.process, [item for item, _, _ in batch])
+        except Exception as error:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            if snapshot is not None:
+                registry.merge(snapshot)
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+
+
+class ExtractionServer:
+    """HTTP/1.1 server for the extraction pipeline.
+
+    ``POST /extract`` takes ``{"text": ...}`` or ``{"texts": [...]}`` and answers
+    with ``{"result": ...}`` or ``{"results": [...]}``. Every sentence is queued
+    on the MicroBatcher separately, so the sentences of concurrent requests share
+    batches. ``GET /health`` and ``GET /metrics`` (Prometheus text) are also served.
+    """
+
+    def __init__(self, batcher, host="127.0.0.1", port=8080):
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+
+    async def serve(self):
+        await self.batcher.start()
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, content_type, payload = await self._route(method, path, body)
+                keep_alive = version == "HTTP/1.1" and headers.get('connection', '').lower() != 'close'
+                payload = payload.encode('utf-8')
+                writer.write(f"{version} {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+                             f"Content-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1')
+                             + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, "application/json", json.dumps({"status": "ok", "pending": self.batcher.pending})
+        if method == "GET" and path == "/metrics":
+            return 200, "text/plain; version=0.0.4", registry.to_prometheus()
+        if method != "POST" or path != "/extract":
+            return 404, "application/json", json.dumps({"error": f"no route for {method} {path}"})
+
+        try:
+            request = json.loads(body)
+            texts = [request["text"]] if "text" in request else request["texts"]
+            if not all(isinstance(text, str) for text in texts):
+                raise TypeError("texts have to be strings")
+        except (ValueError, KeyError, TypeError) as error:
+            return 400, "application/json", json.dumps({"error": f"expected {{\"text\": ...}} or "
+                                                                 f"{{\"texts\": [...]}}: {error}"})
+        try:
+            records = await asyncio.gather(*(self.batcher.submit(text) for text in texts))
+        except Exception as error:
+            return 500, "application/json", json.dumps({"error": repr(error)})
+        # the records are already JSON
+        if "text" in request:
+            return 200, "application/json", '{"result": ' + records[0] + '}'
+        return 200, "application/json", '{"results": [' + ', '.join(records) + ']}'
+
+
+def serve(host="127.0.0.1", port=8080, max_batch_size=32, max_wait=0.01, workers=0, use_coref=True, use_ce=True,
+          torch_threads=None, backend="torch", cache_memory=None, cache_path=None, metrics=False,
+          preload_models=False):
+    options = {"use_coref": use_coref, "use_ce": use_ce, "coref_window": None}
+    cache_options = None
+    if cache_path is not None or cache_memory is not None:
+        cache_options = {"path": cache_path, "max_bytes": (64 if cache_memory is None else cache_memory) * 1024 * 1024}
+    if metrics:
+        registry.enable()
+
+    if workers:
+        # every worker process loads its own models, or shares the preloaded ones, and runs one batch at a time
+        context = multiprocessing.get_context()
+        if preload_models:
+            runner.preload(options, backend)
+            context = multiprocessing.get_context("fork")
+        executor = ProcessPoolExecutor(workers, mp_context=context, initializer=runner._init_worker,
+                                       initargs=(options, torch_threads, backend, cache_options, metrics))
+        batcher = MicroBatcher(runner._process, max_batch_size, max_wait, executor, concurrency=workers)
+    else:
+        runner._init_worker(options, torch_threads, backend, cache_options)
+        executor = ThreadPoolExecutor(1)
+        batcher = MicroBatcher(runner._process, max_batch_size, max_wait, executor)
+
+    try:
+        asyncio.run(ExtractionServer(batcher, host, port).serve())
+    finally:
+        executor.shutdown()
+
+
+def _read_corpus(path):
+    with open(path, "r", encoding='utf-8') as f:
+        return [line for line in f.read().splitlines() if line.strip()]
+
+
+# send the sentences of `texts` to the server from `concurrency` keep-alive connections, one sentence per request
+async def load_test(url, texts, requests=200, concurrency=16):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    path = (parts.path.rstrip('/') or '') + "/extract"
+    queue = islice(cycle(texts), requests)
+    latencies = []
+    errors = [0]
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for text in queue:
+                body = json.dumps({"text": text}).encode('utf-8')
+                start = time.perf_counter()
+                writer.write(f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+                await writer.drain()
+                status = int((await reader.readline()).split()[1])
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value)
+                await reader.readexactly(length)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    errors[0] += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    ordered = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "seconds": seconds,
+        "requests_per_second": len(latencies) / seconds if seconds else 0.0,
+        "p50_ms": percentile(ordered, 50) * 1000,
+        "p95_ms": percentile(ordered, 95) * 1000,
+        "p99_ms": percentile(ordered, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the extraction pipeline over HTTP with micro-batching.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="run the server")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--max-batch-size", type=int, default=32, help="largest batch sent to the models")
+    serve_parser.add_argument("--max-wait-ms", type=float, default=10,
+                              help="how long the first sentence of a batch waits for more sentences")
+    serve_parser.add_argument("--workers", type=int, default=0,
+                              help="worker processes, each with its own models (default: extract in the server "
+                                   "process)")
+    serve_parser.add_argument("--preload", dest="preload_models", action="store_true",
+                              help="load the models once before forking the workers, which share them (CPU backends "
+                                   "torch and quantized)")
+    serve_parser.add_argument("--torch-threads", type=int, default=None, help="torch intra-op threads per process")
+    serve_parser.add_argument("--backend", default="torch", choices=BACKENDS, help="inference backend of the CE models")
+    serve_parser.add_argument("--cache", dest="cache_path", default=None, help="SQLite file that caches results")
+    serve_parser.add_argument("--cache-memory", type=int, default=None, help="size of the in-memory result cache in MB")
+    serve_parser.add_argument("--metrics", action="store_true", help="record metrics, served on GET /metrics")
+    serve_parser.add_argument("--no-coref", dest="use_coref", action="store_false", help="skip coreference resolution")
+    serve_parser.add_argument("--no-ce", dest="use_ce", action="store_false", help="skip cause-and-effect extraction")
+
+    load_parser = subparsers.add_parser("loadgen", help="send concurrent requests to a running server")
+    load_parser.add_argument("--url", default="http://127.0.0.1:8080")
+    load_parser.add_argument("--corpus", default="test/sample.txt", help="one sentence per line")
+    load_parser.add_argument("--requests", type=int, default=200)
+    load_parser.add_argument("--concurrency", type=int, default=16)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        if args.preload_models and (args.backend == "onnx" or causal_extractor.USE_GPU):
+            parser.error("--preload needs the torch or quantized backend on the CPU, ONNX Runtime sessions and CUDA "
+                         "do not survive a fork")
+        serve(args.host, args.port, args.max_batch_size, args.max_wait_ms / 1000, args.workers, args.use_coref,
+              args.use_ce, args.torch_threads, args.backend, args.cache_memory, args.cache_path, args.metrics,
+              args.preload_models)
+    elif args.command == "loadgen":
+        report = asyncio.run(load_test(args.url, _read_corpus(args.corpus), args.requests, args.concurrency))
+        print(f"{report['requests']} requests, {report['errors']} errors in {report['seconds']:.2f} s: "
+              f"{report['requests_per_second']:.1f} requests/s, p50 {report['p50_ms']:.1f} ms, "
+              f"p95 {report['p95_ms']:.1f} ms, p99 {report['p99_ms']:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
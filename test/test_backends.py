@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import backends  # noqa: E402
+
+
+def _logits(module, input_ids, attention_mask):
+    return module(input_ids) * attention_mask.unsqueeze(-1)
+
+
+def _tiny_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Embedding(50, 32), torch.nn.Linear(32, 32), torch.nn.ReLU(),
+                               torch.nn.Linear(32, 4)).eval()
+
+
+def _inputs():
+    input_ids = torch.tensor([[3, 17, 42, 8, 0], [5, 9, 1, 0, 0]])
+    attention_mask = torch.tensor([[1, 1, 1, 1, 0], [1, 1, 1, 0, 0]])
+    return input_ids, attention_mask
+
+
+def _reference():
+    with torch.no_grad():
+        return backends.prepare(_tiny_model(), _logits, "torch")(*_inputs())
+
+
+def test_quantized_matches_fp32():
+    reference = _reference()
+    with torch.no_grad():
+        logits = backends.prepare(_tiny_model(), _logits, "quantized")(*_inputs())
+    assert logits.shape == reference.shape
+    assert (logits - reference).abs().max() <= 0.1 * reference.abs().max()
+
+
+def test_onnx_matches_fp32(tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    reference = _reference()
+    logits = backends.prepare(_tiny_model(), _logits, "onnx", str(tmp_path / "tiny.onnx"))(*_inputs())
+    assert torch.allclose(logits, reference, atol=1e-4)
+
+
+def test_onnx_export_follows_weights(tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    weights = tmp_path / "tiny.bin"
+    onnx_path = str(tmp_path / "tiny.onnx")
+    torch.save(_tiny_model().state_dict(), weights)
+    backends.prepare(_tiny_model(), _logits, "onnx", onnx_path, str(weights))
+    exported = os.path.getmtime(onnx_path)
+
+    # retrained weights: the old export is replaced
+    retrained = torch.nn.Sequential(torch.nn.Embedding(50, 32), torch.nn.Linear(32, 32), torch.nn.ReLU(),
+                                    torch.nn.Linear(32, 4)).eval()
+    torch.save(retrained.state_dict(), weights)
+    os.utime(weights, (exported + 10, exported + 10))
+    logits = backends.prepare(retrained, _logits, "onnx", onnx_path, str(weights))(*_inputs())
+    with torch.no_grad():
+        expected = backends.prepare(retrained, _logits, "torch")(*_inputs())
+    assert torch.allclose(logits, expected, atol=1e-4)
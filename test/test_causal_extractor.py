@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("transformers")
+
+from causal_extractor import offsets_to_string  # noqa: E402
+
+
+def test_offsets_to_string_ascii():
+    text = "The match was cancelled because of heavy rain."
+    assert offsets_to_string(text, [(24, 31), (32, 34), (35, 40), (41, 45)]) == "because of heavy rain"
+
+
+def test_offsets_to_string_accented_span():
+    text = "Das Café schließt, weil es regnet."
+    # byte-level BPE: "é" and "ß" are split into two tokens each, with the offsets of the whole character
+    offsets = [(4, 7), (7, 8), (7, 8), (9, 15), (15, 16), (15, 16), (16, 17)]
+    assert offsets_to_string(text, offsets) == "Café schließt"
+
+
+def test_offsets_to_string_cjk_span():
+    text = "因为下雨, 比赛取消了."
+    offsets = [(0, 1), (0, 1), (0, 1), (1, 2), (1, 2), (2, 3), (3, 4), (3, 4)]
+    assert offsets_to_string(text, offsets) == "因为下雨"
+    assert offsets_to_string(text, [(6, 7), (6, 7), (7, 8), (8, 9)]) == "比赛取"
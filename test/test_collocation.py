@@ -0,0 +1,20 @@
+import os
+
+from collocation import CollocationIndex
+
+
+def test_load_builds_and_reuses_index(tmp_path):
+    path = tmp_path / "collocations.txt"
+    path.write_text("take off\nlook forward to\n", encoding="utf-8")
+    index = CollocationIndex.load(str(path))
+    assert "take off" in index
+    assert os.path.exists(tmp_path / "collocations.idx")
+    assert CollocationIndex.load(str(path)).match("look", [""], ["forward to", "forward", ""]) == ("", "forward to")
+
+
+def test_load_index_without_text_file(tmp_path):
+    path = tmp_path / "collocations.txt"
+    path.write_text("take off\n", encoding="utf-8")
+    CollocationIndex.load(str(path))
+    os.remove(path)
+    assert "take off" in CollocationIndex.load(str(path))
@@ -0,0 +1,26 @@
+import pytest
+
+spacy = pytest.importorskip("spacy")
+
+import component  # noqa: E402
+from resources import LazyResource  # noqa: E402
+
+
+def _tagger_nlp():
+    nlp = spacy.blank("en")
+    nlp.add_pipe("tok2vec")
+    nlp.add_pipe("tagger")
+    doc = nlp.make_doc("dogs bark")
+    nlp.initialize(lambda: [spacy.training.Example.from_dict(doc, {"tags": ["NNS", "VBP"]})])
+    return nlp
+
+
+def test_relation_nlp_shares_extract_nlp(monkeypatch):
+    source = LazyResource(_tagger_nlp)
+    monkeypatch.setattr(component, "nlp", source)
+    relation_nlp = component._load_relation_nlp()
+    assert relation_nlp.pipe_names == ["tok2vec", "tagger", "relation_extractor"]
+    assert relation_nlp.vocab is source.vocab
+    assert relation_nlp.tokenizer is source.tokenizer
+    for name in source.pipe_names:
+        assert relation_nlp.get_pipe(name) is source.get_pipe(name)
@@ -0,0 +1,88 @@
+import pytest
+
+spacy = pytest.importorskip("spacy")
+pytest.importorskip("numpy")
+
+from spacy.tokens import Doc  # noqa: E402
+
+import array_engine  # noqa: E402
+import extract  # noqa: E402
+from array_engine import ArrayAnalysis  # noqa: E402
+from collocation import CollocationIndex  # noqa: E402
+from extract import DocumentAnalysis  # noqa: E402
+
+ENGINES = [DocumentAnalysis, ArrayAnalysis]
+
+
+# resolves pronouns to tokens of other sentences like coref.window_chains
+class WindowChains:
+    def __init__(self, representatives):
+        self.representatives = representatives
+
+    def resolve_token(self, item):
+        return self.representatives.get(item.i)
+
+
+@pytest.fixture(autouse=True)
+def no_collocations(monkeypatch):
+    monkeypatch.setattr(extract, "collocation", CollocationIndex())
+    monkeypatch.setattr(array_engine, "collocation", CollocationIndex())
+
+
+@pytest.fixture(scope="module")
+def vocab():
+    return spacy.blank("en").vocab
+
+
+# "Yesterday the very big dog barked .": the subject dog (4) has the left children the (1) and big (3), and
+# very (2) is a child of big
+def antecedent_doc(vocab):
+    return Doc(vocab, words=["Yesterday", "the", "very", "big", "dog", "barked", "."],
+               heads=[5, 4, 3, 4, 5, 5, 5], deps=["npadvmod", "det", "advmod", "amod", "nsubj", "ROOT", "punct"],
+               pos=["NOUN", "DET", "ADV", "ADJ", "NOUN", "VERB", "PUNCT"])
+
+
+@pytest.mark.parametrize("analysis", ENGINES)
+def test_window_subject_does_not_hide_objects(vocab, analysis):
+    previous = antecedent_doc(vocab)
+    # the object mice has index 2 like "very", which expanding the antecedent of "It" marks visited
+    doc = Doc(vocab, words=["It", "loves", "mice", "."], heads=[1, 1, 1, 1],
+              deps=["nsubj", "ROOT", "dobj", "punct"], pos=["PRON", "VERB", "NOUN", "PUNCT"])
+    chains = WindowChains({0: previous[4]})
+    assert analysis(doc, chains).svos() == [("the big dog", "loves", "mice")]
+
+
+@pytest.mark.parametrize("analysis", ENGINES)
+def test_window_object_keeps_its_children(vocab, analysis):
+    previous = antecedent_doc(vocab)
+    # the verb chase has index 1 like "the" in the antecedent of "it"
+    doc = Doc(vocab, words=["Cats", "chase", "it", "."], heads=[1, 1, 1, 1],
+              deps=["nsubj", "ROOT", "dobj", "punct"], pos=["NOUN", "VERB", "PRON", "PUNCT"])
+    chains = WindowChains({2: previous[4]})
+    assert analysis(doc, chains).svos() == [("Cats", "chase", "the very big dog")]
+
+
+@pytest.mark.parametrize("analysis", ENGINES)
+def test_window_subject_modifier(vocab, analysis):
+    previous = antecedent_doc(vocab)
+    doc = Doc(vocab, words=["It", "loves", "mice", "."], heads=[1, 1, 1, 1],
+              deps=["nsubj", "ROOT", "dobj", "punct"], pos=["PRON", "VERB", "NOUN", "PUNCT"])
+    assert analysis(doc, WindowChains({0: previous[4]})).sms() == [("the big dog", "")]
+
+
+@pytest.mark.parametrize("analysis", ENGINES)
+def test_root_verb_without_subject(vocab, analysis):
+    doc = Doc(vocab, words=["Close", "the", "door", "."], heads=[0, 2, 0, 0],
+              deps=["ROOT", "det", "dobj", "punct"], pos=["VERB", "DET", "NOUN", "PUNCT"])
+    assert analysis(doc).relations() == ([], [], [("Close", "")])
+
+
+# "users love big big ... big mice" with 2000 nested adjectives, expanding the object used to raise RecursionError
+@pytest.mark.parametrize("analysis", ENGINES)
+def test_deep_chain_expands_without_recursion(analysis, vocab):
+    length = 2000
+    doc = Doc(vocab, words=["users", "love"] + ["big"] * length + ["mice"],
+              heads=[1, 1] + list(range(3, length + 3)) + [1], deps=["nsubj", "ROOT"] + ["amod"] * length + ["dobj"],
+              pos=["NOUN", "VERB"] + ["ADJ"] * length + ["NOUN"])
+    svos, sms, vms = analysis(doc).relations()
+    assert svos == [("users", "love", " ".join(["big"] * length + ["mice"]))]
@@ -0,0 +1,44 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import inference  # noqa: E402
+from metrics import registry  # noqa: E402
+
+
+def test_set_threads_returns_previous():
+    previous = torch.get_num_threads()
+    try:
+        assert inference.set_threads(previous + 1) == previous
+        assert torch.get_num_threads() == previous + 1
+        assert inference.set_threads(None) == previous + 1
+        assert torch.get_num_threads() == previous + 1
+    finally:
+        torch.set_num_threads(previous)
+
+
+# the CPU has no per-call peak, only the peak RSS of the process is recorded
+def test_cpu_session_records_process_peak(monkeypatch):
+    monkeypatch.setattr(registry, "enabled", True)
+    registry.reset()
+    session = inference.InferenceSession("double", lambda x: x * 2)
+    inference.SESSIONS.remove(session)
+    try:
+        assert session(torch.ones(2)).tolist() == [2.0, 2.0]
+        assert session.stats()["peak_bytes"] is None
+        assert registry.get("inference_seconds", model="double")["count"] == 1
+        assert registry.get("inference_peak_bytes", model="double") is None
+        assert registry.get("process_peak_rss_bytes")["max"] == pytest.approx(inference.process_peak_rss(), rel=0.5)
+    finally:
+        registry.reset()
+
+
+def test_cpu_session_skips_rss_while_metrics_are_off(monkeypatch):
+    def sample():
+        raise AssertionError("process_peak_rss called while metrics are off")
+
+    monkeypatch.setattr(registry, "enabled", False)
+    monkeypatch.setattr(inference, "process_peak_rss", sample)
+    session = inference.InferenceSession("double", lambda x: x * 2)
+    inference.SESSIONS.remove(session)
+    assert session(torch.ones(2)).tolist() == [2.0, 2.0]
@@ -0,0 +1,23 @@
+from metrics import MetricsRegistry, percentile
+
+
+def test_percentile_nearest_rank():
+    values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    assert percentile(values, 50) == 5
+    assert percentile(values, 95) == 10
+    assert percentile(values, 0) == 1
+    assert percentile([], 50) == 0.0
+
+
+def test_merge_adds_snapshot():
+    worker = MetricsRegistry()
+    worker.enable()
+    worker.count("ce_gate", outcome="classifier")
+    worker.observe("inference_seconds", 0.5, model="tagger")
+    parent = MetricsRegistry()
+    parent.enable()
+    parent.observe("inference_seconds", 1.5, model="tagger")
+    parent.merge(worker.snapshot())
+    assert parent.get("ce_gate", outcome="classifier") == 1
+    assert parent.get("inference_seconds", model="tagger")["count"] == 2
+    assert parent.get("inference_seconds", model="tagger")["max"] == 1.5
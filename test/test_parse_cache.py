@@ -0,0 +1,42 @@
+import pytest
+
+spacy = pytest.importorskip("spacy")
+pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("transformers")
+
+import parse_cache  # noqa: E402
+import pipeline  # noqa: E402
+from coref import window_chains  # noqa: E402
+
+
+# many small batches whose docs are freed after they are saved, so that new docs reuse their ids
+def test_save_parses_links_previous_sentence(monkeypatch, tmp_path):
+    vocab = spacy.blank("en").vocab
+
+    def parse(batches, batch_size, n_process=1, engine=None):
+        for stage_batch in batches:
+            stage_batch.tokens = [spacy.tokens.Doc(vocab, words=text.split()) for text in stage_batch.texts]
+            yield stage_batch
+
+    def coref(batches, use_coref, coref_window):
+        previous = None
+        for stage_batch in batches:
+            stage_batch.corefs = []
+            for doc in stage_batch.tokens:
+                stage_batch.corefs.append(window_chains({} if previous is None else {0: previous[1]}))
+                previous = doc
+            yield stage_batch
+
+    monkeypatch.setattr(pipeline, "_parse_stage", parse)
+    monkeypatch.setattr(pipeline, "_coref_stage", coref)
+    monkeypatch.setattr(parse_cache, "nlp", spacy.blank("en"))
+    texts = [f"it {number}" for number in range(3000)]
+    manifest = parse_cache.save_parses(texts, str(tmp_path), batch_size=2, coref_window=2)
+    assert manifest["sentences"] == 3000
+
+    for number, (doc, chains) in enumerate(parse_cache.read_parses(str(tmp_path))):
+        if number == 0:
+            assert chains.representatives == {}
+        else:
+            assert chains.representatives[0].text == str(number - 1)
@@ -0,0 +1,166 @@
+import threading
+import time
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("transformers")
+spacy = pytest.importorskip("spacy")
+
+import extract  # noqa: E402
+import pipeline  # noqa: E402
+from cache import ResultCache  # noqa: E402
+from resources import LazyResource  # noqa: E402
+
+
+def test_cache_lookup_dedupes_batch():
+    cache = ResultCache()
+    known = (([("it", "rains", "")], [], [("rains", "")]), None)
+    cache.put("It rains.", known)
+    batch = pipeline._StageBatch(["Dogs bark.", "Dogs  bark.", "It rains.", "Dogs bark.", "It rains."])
+    out, = pipeline._cache_lookup_stage(iter([batch]), cache)
+    assert out.texts == ["Dogs bark."]
+    assert out.cached == [0, 0, known, 0, known]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_fingerprint_follows_spacy_model(monkeypatch):
+    def old_model():
+        nlp = spacy.blank("en")
+        nlp.meta["version"] = "3.3.0"
+        return nlp
+
+    def new_model():
+        nlp = spacy.blank("en")
+        nlp.meta["version"] = "3.4.0"
+        return nlp
+
+    monkeypatch.setattr(extract, "nlp", LazyResource(old_model))
+    old = pipeline.cache_fingerprint(use_coref=False, use_ce=False)
+    monkeypatch.setattr(extract, "nlp", LazyResource(new_model))
+    assert pipeline.cache_fingerprint(use_coref=False, use_ce=False) != old
+
+
+def _numbers(count, log, fail_at=None):
+    try:
+        for number in range(count):
+            if number == fail_at:
+                raise ValueError(number)
+            # a slow producer now and then, so that the queue runs both full and empty
+            time.sleep(0.002 * (number % 3))
+            yield number
+    finally:
+        log.append("closed")
+
+
+def test_overlap_keeps_order():
+    log = []
+    assert list(pipeline._overlap_stage(_numbers(50, log), depth=2)) == list(range(50))
+    assert log == ["closed"]
+
+
+def test_overlap_raises_producer_error():
+    log = []
+    seen = []
+    with pytest.raises(ValueError):
+        for number in pipeline._overlap_stage(_numbers(10, log, fail_at=3), depth=2):
+            seen.append(number)
+    assert seen == [0, 1, 2]
+    assert log == ["closed"]
+
+
+def test_overlap_close_stops_producer():
+    log = []
+    stage = pipeline._overlap_stage(_numbers(10 ** 6, log), depth=2)
+    assert [next(stage), next(stage)] == [0, 1]
+    stage.close()
+    assert log == ["closed"]
+    assert not any(thread.name == "extraction-stages" for thread in threading.enumerate())
+
+
+def test_thread_stage_sets_and_restores_threads():
+    previous = torch.get_num_threads()
+    threads = previous + 1
+    seen = [torch.get_num_threads() for _ in pipeline._thread_stage(iter(range(3)), threads)]
+    assert seen == [threads] * 3
+    assert torch.get_num_threads() == previous
+
+
+# with overlap the coreference model runs in the calling thread next to the CE models, not in the parser thread
+def test_overlap_runs_coref_in_calling_thread(monkeypatch):
+    coref_threads = []
+
+    def parse(batches, batch_size, n_process=1, engine=None):
+        for stage_batch in batches:
+            stage_batch.tokens = list(stage_batch.texts)
+            yield stage_batch
+
+    def rules(batches):
+        for stage_batch in batches:
+            stage_batch.relations = [([], [], [])] * len(stage_batch.texts)
+            yield stage_batch
+
+    def chains(text):
+        coref_threads.append(threading.current_thread())
+
+    monkeypatch.setattr(pipeline, "_parse_stage", parse)
+    monkeypatch.setattr(pipeline, "_rule_stage", rules)
+    monkeypatch.setattr(pipeline, "coref_chains", chains)
+    results = list(pipeline.extract_stream(["a", "b", "c"], 2, use_coref=True, use_ce=False, overlap=True))
+    assert [result.text for result in results] == ["a", "b", "c"]
+    assert coref_threads == [threading.current_thread()] * 3
+
+
+# a pipeline with a trainable component, which buffers batch_size docs like the parser does
+def _parser():
+    nlp = spacy.blank("en")
+    nlp.add_pipe("tagger").add_label("NN")
+    nlp.initialize()
+    return nlp
+
+
+def _pulled_batches(texts, log):
+    for stage_batch in pipeline._read_stage(texts, 2):
+        log.append(stage_batch.texts)
+        yield stage_batch
+
+
+def test_parse_stage_reads_one_batch_at_a_time(monkeypatch):
+    monkeypatch.setattr(pipeline, "nlp", _parser())
+    log = []
+    stage = pipeline._parse_stage(_pulled_batches(["a b", "c", "d e f", "g"], log), 4)
+    first = next(stage)
+    assert [doc.text for doc in first.tokens] == ["a b", "c"]
+    assert log == [["a b", "c"]]
+
+
+def test_streaming_parse_keeps_batches(monkeypatch):
+    monkeypatch.setattr(pipeline, "nlp", _parser())
+    texts = [f"sentence {number}" for number in range(9)]
+    batches = list(pipeline._parse_stage(pipeline._read_stage(texts, 2), 2, n_process=2))
+    assert [[doc.text for doc in stage_batch.tokens] for stage_batch in batches] == [
+        stage_batch.texts for stage_batch in batches]
+    assert [text for stage_batch in batches for text in stage_batch.texts] == texts
+
+
+# A sentence repeated in the next batch is found in the cache, its batch was stored before the lookup. The first
+# batch holds a single uncached sentence, a parser that fills its batches would read the next batch ahead.
+def test_cache_hits_neighbouring_batches(monkeypatch):
+    def rules(batches):
+        for stage_batch in batches:
+            stage_batch.relations = [([], [], [])] * len(stage_batch.texts)
+            yield stage_batch
+
+    monkeypatch.setattr(pipeline, "nlp", _parser())
+    monkeypatch.setattr(pipeline, "_rule_stage", rules)
+    cache = ResultCache()
+    texts = ["It rains.", "It rains.", "It rains.", "It snows."]
+    results = list(pipeline.extract_stream(texts, 2, use_coref=False, use_ce=False, cache=cache))
+    assert [result.text for result in results] == texts
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_cache_rejects_parser_processes():
+    with pytest.raises(ValueError):
+        list(pipeline.extract_stream(["It rains."], use_coref=False, use_ce=False, cache=ResultCache(), n_process=2))
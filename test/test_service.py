@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("transformers")
+
+import runner  # noqa: E402
+import service  # noqa: E402
+from metrics import registry  # noqa: E402
+
+
+class _Result:
+    def __init__(self, text):
+        self.text = text
+
+    def to_dict(self):
+        return {"text": self.text}
+
+
+def _fake_stream(texts, batch_size, **options):
+    for text in texts:
+        registry.count("extracted")
+        yield _Result(text)
+
+
+# without workers the batcher runs runner._process in the server process, whose registry must not be reset
+def test_local_batches_keep_server_metrics(monkeypatch):
+    monkeypatch.setattr(runner, "extract_stream", _fake_stream)
+    monkeypatch.setattr(runner, "_report_metrics", False)
+    monkeypatch.setattr(registry, "enabled", True)
+    registry.reset()
+
+    async def run():
+        batcher = service.MicroBatcher(runner._process, max_batch_size=4, max_wait=0.01)
+        await batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.submit(text) for text in ["a", "b", "c"]))
+        finally:
+            await batcher.stop()
+
+    try:
+        assert asyncio.run(run()) == ['{"text": "a"}', '{"text": "b"}', '{"text": "c"}']
+        assert registry.get("extracted") == 3
+        assert registry.get("service_batch_size")["sum"] == 3
+    finally:
+        registry.reset()